@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the agent's hot paths over a generated sparse file tree
+
+Each benchmark is repeated and written out as one JSON line holding its
+timings along with the tree shape, commit and python version, so results
+can be appended to a file and compared across runs
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from generate_sparse_tree import (
+    add_tree_arguments,
+    leaf_files,
+    sparse_files,
+    sparse_tree,
+)
+
+from stignore_agent import helpers
+from stignore_agent.app import app
+from stignore_agent.helpers import load_stignore_file, parse_config, stignore_actions
+from stignore_agent.patterns import compile_patterns
+from stignore_agent.sizes import size_index
+
+
+def cold():
+    """Drops every cache so the next call starts from the disk"""
+    size_index.clear()
+    compile_patterns.cache_clear()
+    helpers._stignore_cache.clear()  # pylint: disable=protected-access
+
+
+def measure(function, repeat, setup=None):
+    """Returns the seconds each of repeat calls to function took"""
+    timings = []
+
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+
+    return timings
+
+
+def commit():
+    """The current git commit, if there is one"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            cwd=Path(__file__).parent,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(content_path, args):
+    # pylint: disable=too-many-locals
+    """Yields (name, timings) for every selected benchmark"""
+    client = app.test_client()
+    content_folder = app.config["folders"][args.name]
+    stignore = content_path / ".stignore"
+    listing = f"/api/v1/{args.name}/listing"
+    report = f"/api/v1/{args.name}/stignore/flush"
+
+    def actions():
+        return stignore_actions(
+            load_stignore_file(stignore, sort=False),
+            content_path,
+            workers=content_folder.size_workers,
+        )
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, response.data
+        return response
+
+    benchmarks = [
+        ("load_stignore_file_cold", lambda: load_stignore_file(stignore), cold),
+        ("load_stignore_file_warm", lambda: load_stignore_file(stignore), None),
+        ("stignore_actions_cold", actions, cold),
+        ("stignore_actions_warm", actions, None),
+        ("listing_cold", lambda: get(listing), cold),
+        ("listing_warm", lambda: get(listing), None),
+    ]
+
+    # Every flush removes the ignored objects, so they are re-created first
+    # exactly as generated, keeping every repeat on the same tree
+    objects, ignored = args.tree
+    plans = []
+
+    def refill():
+        for obj, leaf, count in leaf_files(
+            objects, args.files, args.fanout, args.nesting
+        ):
+            if obj in ignored:
+                sparse_files(leaf, count, args.file_size)
+
+        cold()
+
+    def flush_report():
+        plans.append(get(report).get_json())
+
+    def flush_delete():
+        plan = plans.pop()
+        response = client.post(
+            report, json={"actions": plan["actions"], "token": plan["token"]}
+        )
+        assert response.status_code == 200, response.data
+
+    benchmarks.extend(
+        [
+            ("flush_report", flush_report, refill),
+            ("flush_delete", flush_delete, lambda: (refill(), flush_report())),
+        ]
+    )
+
+    for name, function, setup in benchmarks:
+        if args.only and not any(name.startswith(only) for only in args.only):
+            continue
+
+        plans.clear()
+
+        yield name, measure(function, args.repeat, setup=setup)
+
+
+def main():
+    """Generates the tree, runs every benchmark and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--base-folder",
+        type=Path,
+        help="Folder to generate the tree in, defaults to a temporary one",
+    )
+    add_tree_arguments(parser)
+    # Gives the .stignore parsing benchmarks something to chew on
+    parser.set_defaults(patterns=100)
+    parser.add_argument("--size-workers", type=int, default=1, help="Sizing threads")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark")
+    parser.add_argument(
+        "--only", action="append", help="Only run benchmarks starting with this"
+    )
+    parser.add_argument(
+        "--output", type=Path, help="Append the JSON lines here as well as stdout"
+    )
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="stignore-bench-") as temp_folder:
+        base_folder = args.base_folder or Path(temp_folder)
+        content_path = base_folder / args.name
+
+        started = time.perf_counter()
+        args.tree = sparse_tree(
+            content_path,
+            args.files,
+            depth=args.depth,
+            nesting=args.nesting,
+            fanout=args.fanout,
+            file_size=args.file_size,
+            ignored=args.ignored,
+            patterns=args.patterns,
+        )
+        print(
+            f"Generated {args.files} files in {time.perf_counter() - started:.1f}s",
+            file=sys.stderr,
+        )
+
+        app.config.update(
+            parse_config(
+                {
+                    "base_folder": str(base_folder),
+                    "size_workers": args.size_workers,
+                    "slow_request_ms": 0,
+                    "folders": [{"name": args.name, "depth": args.depth}],
+                }
+            )
+        )
+        app.config["SECRET_KEY"] = "benchmark"
+
+        context = {
+            "commit": commit(),
+            "python": platform.python_version(),
+            "timestamp": time.time(),
+            "files": args.files,
+            "depth": args.depth,
+            "nesting": args.nesting,
+            "fanout": args.fanout,
+            "ignored": args.ignored,
+            "patterns": args.patterns,
+            "size_workers": args.size_workers,
+        }
+
+        with open(args.output or os.devnull, "at", encoding="utf-8") as output:
+            for name, timings in run_benchmarks(content_path, args):
+                line = json.dumps(
+                    {
+                        "benchmark": name,
+                        **context,
+                        "repeat": len(timings),
+                        "min_s": min(timings),
+                        "median_s": statistics.median(timings),
+                        "mean_s": statistics.mean(timings),
+                        "max_s": max(timings),
+                    }
+                )
+                print(line, flush=True)
+                output.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Generates a large content type tree made of sparse files
+
+Every file is created by truncating it to its size, so trees of millions
+of files report realistic sizes while taking next to no disk space
+"""
+
+import argparse
+
+from pathlib import Path
+
+import yaml
+
+
+def leaf_folders(path, fanout, levels):
+    """Yields every folder levels deep underneath path, creating them"""
+    if levels == 0:
+        yield path
+        return
+
+    for number in range(1, fanout + 1):
+        child = path / f"Folder {number}"
+        child.mkdir(parents=True, exist_ok=True)
+
+        yield from leaf_folders(child, fanout, levels - 1)
+
+
+def sparse_files(path, count, file_size):
+    """Creates count sparse files of file_size bytes inside path"""
+    for number in range(1, count + 1):
+        with open(path / f"File {number}", "wb") as sparse_file:
+            sparse_file.truncate(file_size)
+
+
+def leaf_files(objects, files, fanout=10, nesting=1):
+    """
+    Yields (object, leaf, count) spreading files evenly over the leaves
+    nesting levels of fanout folders underneath every object
+    """
+    leaves = [
+        (obj, leaf) for obj in objects for leaf in leaf_folders(obj, fanout, nesting)
+    ]
+
+    per_leaf, remainder = divmod(files, len(leaves))
+
+    for number, (obj, leaf) in enumerate(leaves):
+        yield obj, leaf, per_leaf + (number < remainder)
+
+
+def sparse_tree(
+    content_path,
+    files,
+    depth=0,
+    nesting=1,
+    fanout=10,
+    file_size=1024**2,
+    ignored=0.1,
+    patterns=0,
+):
+    # pylint: disable=too-many-arguments,too-many-locals
+    """
+    Creates a content type at content_path holding files sparse files
+
+    There are fanout folders at each of the depth + 1 levels a listing
+    looks through, every one of those objects nests nesting further levels
+    of fanout folders, and the files are spread evenly over the innermost
+    ones (see leaf_files). The .stignore written alongside ignores the
+    given fraction of the objects, followed by patterns entries that match
+    nothing to give the parser and matcher some work. Returns the objects
+    and the ignored ones.
+    """
+    content_path.mkdir(parents=True, exist_ok=True)
+
+    objects = list(leaf_folders(content_path, fanout, depth + 1))
+
+    for _, leaf, count in leaf_files(objects, files, fanout, nesting):
+        sparse_files(leaf, count, file_size)
+
+    step = max(1, round(1 / ignored)) if ignored else 0
+    ignored_objects = objects[::step] if step else []
+
+    with open(content_path / ".stignore", "wt", encoding="utf-8") as stignore:
+        # Anchored, so they can't also match folders of the same name deeper in
+        for obj in ignored_objects:
+            stignore.write(f"/{obj.relative_to(content_path)}\n")
+
+        for number in range(1, patterns + 1):
+            stignore.write(
+                f"Missing {number}\n" if number % 2 else f"*.missing{number}\n"
+            )
+
+    return objects, ignored_objects
+
+
+def add_tree_arguments(argument_parser):
+    """Adds the options describing the tree's shape to parser"""
+    argument_parser.add_argument("--name", default="bench", help="Content type name")
+    argument_parser.add_argument(
+        "--files", type=int, default=10**4, help="Files to create"
+    )
+    argument_parser.add_argument(
+        "--depth", type=int, default=0, help="Listing search depth"
+    )
+    argument_parser.add_argument(
+        "--nesting", type=int, default=1, help="Folder levels inside each object"
+    )
+    argument_parser.add_argument(
+        "--fanout", type=int, default=10, help="Folders per level"
+    )
+    argument_parser.add_argument(
+        "--file-size", type=int, default=1024**2, help="Apparent bytes per file"
+    )
+    argument_parser.add_argument(
+        "--ignored", type=float, default=0.1, help="Fraction of objects to ignore"
+    )
+    argument_parser.add_argument(
+        "--patterns", type=int, default=0, help="Extra .stignore entries to add"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("base_folder", type=Path, help="Folder to create the tree in")
+    add_tree_arguments(parser)
+
+    args = parser.parse_args()
+
+    sparse_tree(
+        args.base_folder / args.name,
+        args.files,
+        depth=args.depth,
+        nesting=args.nesting,
+        fanout=args.fanout,
+        file_size=args.file_size,
+        ignored=args.ignored,
+        patterns=args.patterns,
+    )
+
+    config = {
+        "base_folder": str(args.base_folder.resolve()),
+        "folders": [{"name": args.name, "depth": args.depth}],
+    }
+
+    with open(args.base_folder / "config.yml", "wt", encoding="utf-8") as config_file:
+        yaml.dump(config, config_file, explicit_start=True)
+
+    print(f"Created {args.files} files in {args.base_folder / args.name}")
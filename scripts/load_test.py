@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+End-to-end HTTP load test of the agent
+
+Starts bin/stignore-agent against a generated sparse tree on localhost (or
+targets an already running agent with --url), then has many concurrent
+clients drive a weighted mix of routes. Throughput and p50/p95/p99
+latency are printed per route as JSON lines, and the exit status is
+non-zero when a --max-* / --min-* threshold is broken, so it can gate
+deployments.
+
+The stignore_post route writes to the .stignore files, so against a
+running agent it is only sent with --allow-writes. Every entry it added
+is removed again once the run finishes.
+"""
+
+import argparse
+import http.client
+import json
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import yaml
+
+from generate_sparse_tree import sparse_tree
+
+AGENT = Path(__file__).resolve().parent.parent / "bin" / "stignore-agent"
+
+ROUTES = {
+    "discover": lambda ct, client: ("GET", "/api/v1/discover", None),
+    "listing": lambda ct, client: ("GET", f"/api/v1/{ct}/listing", None),
+    "stignore": lambda ct, client: ("GET", f"/api/v1/{ct}/stignore", None),
+    "stignore_post": lambda ct, client: (
+        "POST",
+        f"/api/v1/{ct}/stignore",
+        {
+            "actions": [
+                {
+                    # Every client toggles its own entry so the file stays put
+                    "action": random.choice(("add", "remove")),
+                    "ignore_type": "ignore",
+                    "name": f"Load Test {client}",
+                }
+            ]
+        },
+    ),
+    "flush_report": lambda ct, client: ("GET", f"/api/v1/{ct}/stignore/flush", None),
+}
+
+DEFAULT_MIX = "discover=1,listing=4,stignore=2,stignore_post=1,flush_report=1"
+
+
+def load_test_entries(clients):
+    """The remove actions for every entry stignore_post may have added"""
+    return [
+        {"action": "remove", "ignore_type": "ignore", "name": f"Load Test {client}"}
+        for client in range(clients)
+    ]
+
+
+def parse_mix(mix):
+    """Parses route=weight pairs into a dict of weights"""
+    weights = {}
+
+    for pair in mix.split(","):
+        route, _, weight = pair.partition("=")
+
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f"Unknown route {route}")
+
+        weights[route] = float(weight or 1)
+
+    return weights
+
+
+def percentile(timings, percent):
+    """Nearest rank percentile of an already sorted list"""
+    if not timings:
+        return None
+
+    rank = max(0, min(len(timings) - 1, round(percent / 100 * len(timings)) - 1))
+    return timings[rank]
+
+
+def free_port():
+    """A port nothing is listening on right now"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(host, port, timeout=30):
+    """Polls the info page until the agent answers"""
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=1)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise TimeoutError(f"Agent didn't start listening on {host}:{port}")
+
+
+def start_agent(base_folder, args):
+    """Generates the trees and config, then starts the agent on a free port"""
+    config = {
+        "base_folder": str(base_folder),
+        "size_workers": args.size_workers,
+        "folders": [],
+    }
+
+    for number in range(1, args.content_types + 1):
+        name = f"share-{number}"
+        sparse_tree(base_folder / name, args.files, depth=args.depth, fanout=10)
+        config["folders"].append({"name": name, "depth": args.depth})
+
+    config_path = base_folder / "config.yml"
+
+    with open(config_path, "wt", encoding="utf-8") as config_file:
+        yaml.dump(config, config_file, explicit_start=True)
+
+    port = free_port()
+    command = [
+        sys.executable,
+        str(AGENT),
+        "--config-file",
+        str(config_path),
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(port),
+    ]
+
+    if args.production:
+        command.extend(
+            ["--production", "--workers", str(args.workers)]
+            + ["--threads", str(args.threads)]
+        )
+
+    # pylint: disable=consider-using-with
+    agent = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    try:
+        wait_until_up("127.0.0.1", port)
+    except TimeoutError:
+        agent.terminate()
+        raise
+
+    return agent, f"http://127.0.0.1:{port}"
+
+
+class Client(threading.Thread):
+    """Sends requests picked from the route mix until told to stop"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, number, url, content_types, weights, results):
+        # pylint: disable=too-many-arguments
+        super().__init__(name=f"load-client-{number}", daemon=True)
+
+        self.number = number
+        self.url = urlsplit(url)
+        self.content_types = content_types
+        self.routes = list(weights)
+        self.weights = list(weights.values())
+        self.results = results
+        self.recording = threading.Event()
+        self.stopping = threading.Event()
+
+        self._connection = None
+
+    def run(self):
+        while not self.stopping.is_set():
+            route = random.choices(self.routes, self.weights)[0]
+            method, path, payload = ROUTES[route](
+                random.choice(self.content_types), self.number
+            )
+
+            started = time.perf_counter()
+            status = self._request(method, path, payload)
+            seconds = time.perf_counter() - started
+
+            if self.recording.is_set():
+                self.results.append((route, seconds, status))
+
+    def _request(self, method, path, payload):
+        body = json.dumps(payload) if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body else {}
+
+        try:
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(
+                    self.url.hostname, self.url.port, timeout=60
+                )
+
+            self._connection.request(method, path, body=body, headers=headers)
+            response = self._connection.getresponse()
+            response.read()
+
+            if response.will_close:
+                self._close()
+
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self._close()
+            return None
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def discover(url):
+    """The names of every content type the agent monitors"""
+    connection = http.client.HTTPConnection(urlsplit(url).hostname, urlsplit(url).port)
+    connection.request("GET", "/api/v1/discover")
+    content_types = [
+        content_type["name"]
+        for content_type in json.loads(connection.getresponse().read())["content_types"]
+    ]
+    connection.close()
+
+    return content_types
+
+
+def remove_load_test_entries(url, content_types, clients):
+    """Removes every Load Test entry from the content types' .stignore files"""
+    connection = http.client.HTTPConnection(urlsplit(url).hostname, urlsplit(url).port)
+
+    for content_type in content_types:
+        connection.request(
+            "POST",
+            f"/api/v1/{content_type}/stignore",
+            body=json.dumps({"actions": load_test_entries(clients)}),
+            headers={"Content-Type": "application/json"},
+        )
+        connection.getresponse().read()
+
+    connection.close()
+
+
+def run_load(url, args):
+    """
+    Runs the clients for the warmup and duration, returns the results
+    Any entries stignore_post added are removed again afterwards
+    """
+    content_types = discover(url)
+
+    try:
+        return run_clients(url, content_types, args)
+    finally:
+        if "stignore_post" in args.mix:
+            remove_load_test_entries(url, content_types, args.clients)
+
+
+def run_clients(url, content_types, args):
+    """Runs the clients against content_types, returns the results"""
+
+    results = []
+    clients = [
+        Client(number, url, content_types, args.mix, results)
+        for number in range(args.clients)
+    ]
+
+    for client in clients:
+        client.start()
+
+    time.sleep(args.warmup)
+
+    for client in clients:
+        client.recording.set()
+
+    time.sleep(args.duration)
+
+    for client in clients:
+        client.stopping.set()
+        client.recording.clear()
+
+    for client in clients:
+        client.join(timeout=60)
+
+    return results
+
+
+def summarise(results, duration):
+    """Yields a summary of throughput, errors and latencies per route"""
+    by_route = defaultdict(list)
+
+    for route, seconds, status in results:
+        by_route[route].append((seconds, status))
+        by_route["all"].append((seconds, status))
+
+    for route, samples in sorted(by_route.items()):
+        timings = sorted(seconds for seconds, _ in samples)
+        rejected = sum(1 for _, status in samples if status == 503)
+        errors = sum(1 for _, status in samples if status is None or status >= 500)
+
+        yield {
+            "route": route,
+            "requests": len(samples),
+            "requests_per_second": len(samples) / duration,
+            "error_rate": (errors - rejected) / len(samples),
+            "rejected_rate": rejected / len(samples),
+            "p50_ms": percentile(timings, 50) * 1000,
+            "p95_ms": percentile(timings, 95) * 1000,
+            "p99_ms": percentile(timings, 99) * 1000,
+            "max_ms": timings[-1] * 1000,
+        }
+
+
+def failures(summary, args):
+    """Returns every threshold the overall summary breaks"""
+    broken = []
+
+    if args.max_p99_ms is not None and summary["p99_ms"] > args.max_p99_ms:
+        broken.append(f"p99 {summary['p99_ms']:.1f}ms > {args.max_p99_ms}ms")
+
+    if args.max_p95_ms is not None and summary["p95_ms"] > args.max_p95_ms:
+        broken.append(f"p95 {summary['p95_ms']:.1f}ms > {args.max_p95_ms}ms")
+
+    if summary["error_rate"] > args.max_error_rate:
+        broken.append(
+            f"error rate {summary['error_rate']:.2%} > {args.max_error_rate:.2%}"
+        )
+
+    if (
+        args.max_rejected_rate is not None
+        and summary["rejected_rate"] > args.max_rejected_rate
+    ):
+        broken.append(
+            f"rejected rate {summary['rejected_rate']:.2%}"
+            f" > {args.max_rejected_rate:.2%}"
+        )
+
+    if args.min_rps is not None and summary["requests_per_second"] < args.min_rps:
+        broken.append(
+            f"throughput {summary['requests_per_second']:.1f}/s < {args.min_rps}/s"
+        )
+
+    return broken
+
+
+def main():
+    """Starts the agent, runs the load and reports, returns the exit status"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", help="Load test this running agent instead")
+    parser.add_argument(
+        "--mix", type=parse_mix, default=DEFAULT_MIX, help="route=weight pairs"
+    )
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds measured")
+    parser.add_argument(
+        "--warmup", type=float, default=5, help="Seconds run before measuring"
+    )
+    parser.add_argument(
+        "--content-types", type=int, default=2, help="Content types to generate"
+    )
+    parser.add_argument(
+        "--files", type=int, default=10**4, help="Files per content type"
+    )
+    parser.add_argument("--depth", type=int, default=0, help="Listing search depth")
+    parser.add_argument("--size-workers", type=int, default=2, help="Sizing threads")
+    parser.add_argument(
+        "--development",
+        dest="production",
+        action="store_false",
+        help="Use the flask development server instead of gunicorn",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Gunicorn workers")
+    parser.add_argument("--threads", type=int, default=8, help="Gunicorn threads")
+    parser.add_argument("--max-p99-ms", type=float, help="Fail over this p99")
+    parser.add_argument("--max-p95-ms", type=float, help="Fail over this p95")
+    parser.add_argument(
+        "--max-error-rate",
+        type=float,
+        default=0.0,
+        help="Fail over this fraction of failed or 5xx responses",
+    )
+    parser.add_argument(
+        "--max-rejected-rate",
+        type=float,
+        help="Fail over this fraction of 503s from walk admission",
+    )
+    parser.add_argument("--min-rps", type=float, help="Fail under this throughput")
+    parser.add_argument(
+        "--allow-writes",
+        action="store_true",
+        help="Send stignore_post to the agent given by --url, editing its .stignore",
+    )
+
+    args = parser.parse_args()
+
+    if args.url is not None and not args.allow_writes and "stignore_post" in args.mix:
+        # A running agent's .stignore files are real, only write with consent
+        del args.mix["stignore_post"]
+        print(
+            "Leaving out stignore_post, pass --allow-writes to send it", file=sys.stderr
+        )
+
+    agent = None
+
+    with tempfile.TemporaryDirectory(prefix="stignore-load-") as base_folder:
+        try:
+            if args.url is None:
+                agent, args.url = start_agent(Path(base_folder), args)
+
+            results = run_load(args.url, args)
+        finally:
+            if agent is not None:
+                agent.terminate()
+                agent.wait(timeout=60)
+
+    if not results:
+        print("No requests completed", file=sys.stderr)
+        return 1
+
+    broken = []
+
+    for summary in summarise(results, args.duration):
+        print(json.dumps(summary), flush=True)
+
+        if summary["route"] == "all":
+            broken = failures(summary, args)
+
+    for failure in broken:
+        print(f"FAILED: {failure}", file=sys.stderr)
+
+    return 1 if broken else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+stignore-agent admission
+
+Concurrency limits for the endpoints that walk the filesystem
+"""
+import threading
+import time
+
+from collections import Counter
+
+
+class AdmissionControl:
+    """
+    Bounds how many walks run at once, globally and per content type
+
+    Requests over a limit wait in a short queue for a slot to free up,
+    once max_queued requests are already waiting (or one has waited for
+    queue_timeout seconds) further requests are rejected straight away.
+    """
+
+    def __init__(self):
+        self.running = Counter()
+        self.rejected = Counter()
+        self.admitted = Counter()
+        self.queued = 0
+
+        self._condition = threading.Condition()
+
+    def acquire(self, content_type, limits):
+        """
+        Takes a walk slot for content_type, returns False if rejected
+        limits carries max_concurrent, max_concurrent_per_type, max_queued
+        and queue_timeout
+        """
+        deadline = time.monotonic() + limits.queue_timeout
+
+        with self._condition:
+            if not self._has_slot(content_type, limits):
+                if self.queued >= limits.max_queued:
+                    self.rejected[content_type] += 1
+                    return False
+
+                self.queued += 1
+
+                try:
+                    while not self._has_slot(content_type, limits):
+                        remaining = deadline - time.monotonic()
+
+                        if remaining <= 0:
+                            self.rejected[content_type] += 1
+                            return False
+
+                        self._condition.wait(remaining)
+                finally:
+                    self.queued -= 1
+
+            self.running[content_type] += 1
+            self.admitted[content_type] += 1
+
+        return True
+
+    def release(self, content_type):
+        """Gives back a slot taken by acquire"""
+        with self._condition:
+            self.running[content_type] -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        """Snapshot of the running, queued, admitted and rejected counts"""
+        with self._condition:
+            return {
+                "running": {k: v for k, v in self.running.items() if v},
+                "queued": self.queued,
+                "admitted": dict(self.admitted),
+                "rejected": dict(self.rejected),
+            }
+
+    def _has_slot(self, content_type, limits):
+        if sum(self.running.values()) >= limits.max_concurrent:
+            return False
+
+        return self.running[content_type] < limits.max_concurrent_per_type
+
+
+admission = AdmissionControl()
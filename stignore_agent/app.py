@@ -5,19 +5,116 @@ A basic flask API that provides a set of endpoints to:
 * Work with content types (folders underneath the base)
 * Manipulate each content types .stignore file
 """
-import shutil
-
-from flask import Flask, current_app, request, jsonify, send_from_directory
-
-from stignore_agent.helpers import load_stignore_file, stignore_actions, load_actions
+# pylint: disable=too-many-lines
+import functools
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import (
+    Flask,
+    Response,
+    current_app,
+    g,
+    request,
+    jsonify,
+    make_response,
+    send_file,
+    send_from_directory,
+)
+
+from stignore_agent.helpers import (
+    apply_stignore_actions,
+    content_etag,
+    content_type_summary,
+    flush_plan,
+    flush_report_key,
+    ignore_trash_folder,
+    listing_folders,
+    load_stignore_file,
+    stignore_actions,
+    load_actions,
+    paginate_folders,
+    sign_flush_plan,
+    validate_flush_actions,
+    verify_flush_plan,
+)
+from stignore_agent import metrics
+from stignore_agent.admission import admission
+from stignore_agent.coalesce import single_flight
+from stignore_agent.deletion import (
+    move_to_trash,
+    remove_actions,
+    restore_trash,
+    trash_entries,
+)
+from stignore_agent.jobs import job_queue, trash_purger
+from stignore_agent.profiling import (
+    SORT_KEYS,
+    profile_call,
+    profile_entries,
+    profile_path,
+    render_profile,
+)
+from stignore_agent.sizes import SIZE_MODES, size_index
+from stignore_agent.timing import PhaseTimer
 
 
 app = Flask("stignore-agent")
 
+NDJSON = "application/x-ndjson"
+PROFILE_HEADER = "X-Stignore-Profile"
+
+
+metrics.registry.gauge(
+    "stignore_walks_running",
+    "Walks currently holding an admission slot, by content type",
+    lambda: {(k,): v for k, v in admission.stats()["running"].items()},
+    ("content_type",),
+)
+metrics.registry.gauge(
+    "stignore_walks_queued",
+    "Requests waiting for an admission slot",
+    lambda: admission.stats()["queued"],
+)
+metrics.registry.gauge(
+    "stignore_walks_in_flight",
+    "Distinct coalesced walks currently running",
+    single_flight.in_flight,
+)
+metrics.registry.gauge(
+    "stignore_flush_jobs_queued",
+    "Background flush jobs waiting to run",
+    job_queue.depth,
+)
+
+
+@app.before_request
+def before_request():
+    """Start timing the request's phases"""
+    g.timer = PhaseTimer()
+
 
 @app.after_request
 def after_request(response):
-    """Apply extra CORS header"""
+    """
+    Apply extra CORS header, record the request's latency and attach its
+    phase breakdown as a Server-Timing header
+    Streamed responses are timed up to their first byte, their slow log
+    line is written once the stream is closed
+    """
+    if "timer" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.request_seconds.observe(
+            g.timer.elapsed(), route=route, method=request.method
+        )
+        metrics.requests_total.inc(
+            route=route, method=request.method, status=response.status_code
+        )
+
+        response.headers["Server-Timing"] = g.timer.header()
+        response.call_on_close(slow_request_logger(g.timer, response.status_code))
+
     headers = response.headers
     headers["Access-Control-Allow-Origin"] = "*"
     headers["Access-Control-Allow-Methods"] = "*"
@@ -25,6 +122,187 @@ def after_request(response):
     return response
 
 
+def slow_request_logger(timer, status):
+    """
+    Returns a callable writing a structured log line for the current
+    request if it has taken longer than slow_request_ms by then
+    """
+    threshold = current_app.config.get("slow_request_ms")
+    logger = current_app.config.get("logger") or current_app.logger
+
+    content_type = (request.view_args or {}).get("content_type")
+    content_folder = current_app.config.get("folders", {}).get(content_type)
+
+    line = {
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "status": status,
+        "content_type": content_type,
+        "depth": content_folder.depth if content_folder is not None else None,
+    }
+
+    def log():
+        duration_ms = timer.elapsed() * 1000
+
+        if not threshold or duration_ms < threshold:
+            return
+
+        line["duration_ms"] = round(duration_ms, 2)
+        line["phases_ms"] = {
+            name: round(seconds * 1000, 2) for name, seconds in timer.phases.items()
+        }
+        line["directories"] = timer.counts["directories"]
+        line["files"] = timer.counts["files"]
+
+        logger.warning("slow request %s", json.dumps(line))
+
+    return log
+
+
+def size_workers(content_folder):
+    """Sizing threads for content_folder, profiled requests size serially"""
+    return 1 if g.get("profiling") else content_folder.size_workers
+
+
+def size_mode():
+    """
+    The ?size= mode requested, "none", "apparent" (the default) or "blocks"
+    Returns None when it isn't one of them
+    """
+    mode = request.args.get("size", "apparent")
+    return mode if mode == "none" or mode in SIZE_MODES else None
+
+
+def estimate_budget():
+    """
+    The (max_files, max_seconds) budget of an ?estimate=true listing
+    Falls back to the configured budget, returns None when invalid
+    """
+    try:
+        max_files = int(
+            request.args.get("max_files", current_app.config["estimate_max_files"])
+        )
+        max_ms = int(request.args.get("max_ms", current_app.config["estimate_max_ms"]))
+    except ValueError:
+        return None
+
+    if max_files < 0 or max_ms < 0:
+        return None
+
+    return max_files, max_ms / 1000
+
+
+def coalesced(key, function):
+    """
+    Shares function() with concurrent callers using key
+    Profiled requests always run their own so the walk is captured
+    """
+    if g.get("profiling"):
+        return function()
+
+    return single_flight.run(key, function)
+
+
+def listing_mimetype():
+    """NDJSON when asked for by ?format=ndjson or Accept, otherwise JSON"""
+    if request.args.get("format") == "ndjson":
+        return NDJSON
+
+    if request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON:
+        return NDJSON
+
+    return "application/json"
+
+
+def not_modified(etag):
+    """Empty 304 response for clients already holding the current etag"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def walk_admission(view):
+    """
+    Applies the walk concurrency limits to a content type view
+    Over the limit requests get a fast 503 with Retry-After
+    Streamed responses hold their slot until the stream is closed
+    """
+
+    @functools.wraps(view)
+    def wrapper(content_type, *args, **kwargs):
+        content_folder = current_app.config["folders"].get(content_type)
+
+        if content_folder is None:
+            # Left for the view to reject
+            return view(content_type, *args, **kwargs)
+
+        return admitted(
+            content_type, content_folder, lambda: view(content_type, *args, **kwargs)
+        )
+
+    return wrapper
+
+
+def admitted(content_type, content_folder, walk):
+    """
+    Calls walk holding one of content_type's walk slots, see walk_admission
+    Returns walk's response, or a 503 when no slot could be had
+    """
+    if not admission.acquire(content_type, content_folder.walk_limits):
+        return (
+            jsonify({"ok": False, "msg": "Too many concurrent walks, retry later"}),
+            503,
+            {"Retry-After": str(max(1, int(content_folder.walk_limits.queue_timeout)))},
+        )
+
+    try:
+        response = make_response(walk())
+    except BaseException:
+        admission.release(content_type)
+        raise
+
+    if response.is_streamed:
+        response.call_on_close(lambda: admission.release(content_type))
+    else:
+        admission.release(content_type)
+
+    return response
+
+
+def profiled(view):
+    """
+    Runs a content type view under cProfile when profile_dir is configured
+    and the request carries the X-Stignore-Profile header
+    Sizing runs serially on the request thread so the walk is captured,
+    streamed responses are buffered within the profile. The saved
+    profile's id is returned in the X-Stignore-Profile-Id header
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        profile_dir = current_app.config.get("profile_dir")
+
+        if profile_dir is None or not request.headers.get(PROFILE_HEADER):
+            return view(*args, **kwargs)
+
+        g.profiling = True
+
+        def run():
+            response = make_response(view(*args, **kwargs))
+
+            if response.is_streamed:
+                response.make_sequence()
+
+            return response
+
+        response, profile_id = profile_call(profile_dir, view.__name__, run)
+        response.headers[f"{PROFILE_HEADER}-Id"] = profile_id
+
+        return response
+
+    return wrapper
+
+
 @app.route("/")
 def info_page():
     """Basic info page for users discovering this through their browser"""
@@ -44,23 +322,83 @@ def favicon():
 
 @app.route("/api/v1/discover")
 def list_content_types():
-    """Returns all configured content type folders"""
+    """
+    Returns all configured content type folders
+    Passing ?sizes=true adds each content type's total size, folder count
+    and pending flush size, content types being walked concurrently up to
+    max_concurrent_walks at a time so the request never outruns its own
+    walk slots
+    """
     folders = current_app.config["folders"]
 
-    return jsonify(
-        {"ok": True, "content_types": list({"name": name} for name in folders.keys())}
-    )
+    if request.args.get("sizes", "").lower() not in ("true", "1"):
+        return jsonify(
+            {
+                "ok": True,
+                "content_types": list({"name": name} for name in folders.keys()),
+            }
+        )
+
+    timer = g.timer
+
+    def summary(name):
+        content_folder = folders[name]
+
+        if not content_folder.path.exists():
+            return {"name": name, "ok": False, "msg": "Content type does not exist"}
+
+        if not admission.acquire(name, content_folder.walk_limits):
+            return {
+                "name": name,
+                "ok": False,
+                "msg": "Too many concurrent walks, retry later",
+            }
+
+        try:
+            return {
+                "name": name,
+                "ok": True,
+                **content_type_summary(name, content_folder, timer=timer),
+            }
+        finally:
+            admission.release(name)
+
+    with ThreadPoolExecutor(
+        max_workers=max(
+            1, min(len(folders), current_app.config["max_concurrent_walks"])
+        ),
+        thread_name_prefix="stignore-discover",
+    ) as executor:
+        content_types = list(executor.map(summary, folders.keys()))
+
+    with timer.phase("encode"):
+        return jsonify({"ok": True, "content_types": content_types})
 
 
 @app.route("/api/v1/<content_type>/listing")
+@profiled
 def content_type_listing(content_type: str):
     """
     Given a valid content type we return a listing of all folders underneath it
     Also respecting configured search depth
+
+    Supports ?limit=&cursor= pagination, only the returned page is sized
+    ?size=blocks sizes by the space deleting each folder would free,
+    ?size=none skips sizing and returns the folder names only
+    ?estimate=true sizes each folder within a budget of ?max_files= stat'ed
+    and ?max_ms=, folders too large for it are estimated from a sample and
+    flagged approximate. Estimated listings carry no ETag as they refine
+    once background walks finish
+    Clients accepting application/x-ndjson (or passing ?format=ndjson) get
+    one folder per line, streamed as soon as each folder has been sized
+    Matching If-None-Match polls are answered before taking a walk slot
     """
-    folders = current_app.config["folders"]
+    timer = g.timer
+    size = size_mode()
+    estimate = request.args.get("estimate", "").lower() in ("true", "1")
 
-    content_folder = folders.get(content_type)
+    with timer.phase("config"):
+        content_folder = current_app.config["folders"].get(content_type)
 
     if content_folder is None:
         return (
@@ -68,46 +406,133 @@ def content_type_listing(content_type: str):
             400,
         )
 
-    search_depth = content_folder.depth + 1
-
     if not content_folder.path.exists():
         return (
             jsonify({"ok": False, "msg": "Provided content_type does not exist"}),
             400,
         )
 
-    folders = []
+    if size is None:
+        return jsonify({"ok": False, "msg": "Provided size is invalid"}), 400
 
-    search_glob = "/".join("*" * search_depth)
+    budget = None
 
-    for content in content_folder.path.glob(search_glob):
-        if not content.is_dir():
-            # We're only interested in folders
-            continue
+    if estimate and size != "none":
+        budget = estimate_budget()
 
-        if content.name.startswith(".st"):
-            # We skip the syncthing specific folders
-            continue
+        if budget is None:
+            return (
+                jsonify({"ok": False, "msg": "Provided estimate budget is invalid"}),
+                400,
+            )
 
-        folders.append(
-            {
-                "name": content.name,
-                "size_megabytes": round(
-                    sum(f.stat().st_size for f in content.glob("**/*") if f.is_file())
-                    / 1024
-                    / 1024,
-                    2,
-                ),
-            }
+    etag = None
+
+    if budget is None:
+        # JSON and NDJSON bodies of the same URL are different documents
+        etag = content_etag(
+            content_folder,
+            request.full_path,
+            listing_mimetype(),
+            ttl=current_app.config["etag_ttl"],
         )
 
-    return jsonify(
-        {
-            "ok": True,
-            "folders": sorted(folders, key=lambda x: x["name"]),
-        }
+        if request.if_none_match.contains(etag):
+            response = not_modified(etag)
+            response.vary.add("Accept")
+            return response
+
+    response = make_response(
+        admitted(
+            content_type,
+            content_folder,
+            lambda: listing_response(content_type, content_folder, size, budget, etag),
+        )
+    )
+    response.vary.add("Accept")
+
+    return response
+
+
+def listing_response(content_type, content_folder, size, budget, etag):
+    """
+    Walks content_folder for content_type_listing and builds the response
+    """
+    timer = g.timer
+
+    # One walk through the index finds the folders at the search depth
+    # skipping the syncthing specific folders, each is then sized concurrently
+    contents = size_index.folders(
+        content_folder.path, content_folder.depth, timer=timer
     )
 
+    with timer.phase("sort"):
+        contents = sorted(contents, key=lambda x: (x.name, str(x)))
+
+    page = paginate_folders(
+        contents,
+        content_folder.path,
+        limit=request.args.get("limit"),
+        cursor=request.args.get("cursor"),
+    )
+
+    if not page["ok"]:
+        return jsonify(page), 400
+
+    contents = page["folders"]
+
+    folders = listing_folders(
+        contents, size, budget, workers=size_workers(content_folder), timer=timer
+    )
+
+    if listing_mimetype() == NDJSON:
+        # Each folder is encoded as soon as it has been sized
+        def lines():
+            for folder in folders:
+                with timer.phase("encode"):
+                    line = json.dumps(folder) + "\n"
+
+                yield line
+
+        response = Response(lines(), mimetype=NDJSON)
+
+        if page["next_cursor"] is not None:
+            response.headers["X-Next-Cursor"] = page["next_cursor"]
+
+        if etag is not None:
+            response.set_etag(etag)
+
+        return response
+
+    # Concurrent requests for the same page share a single sizing walk
+    listing = {
+        "ok": True,
+        "folders": coalesced(
+            (
+                "listing",
+                content_type,
+                size,
+                budget,
+                tuple(str(content) for content in contents),
+            ),
+            lambda: list(folders),
+        ),
+    }
+
+    if page["paginated"]:
+        listing["next_cursor"] = page["next_cursor"]
+
+    if budget is not None:
+        listing["approximate"] = any(f["approximate"] for f in listing["folders"])
+
+    with timer.phase("encode"):
+        response = jsonify(listing)
+
+    if etag is not None:
+        response.set_etag(etag)
+
+    return response
+
 
 @app.route("/api/v1/<content_type>/stignore")
 def stignore_listing(content_type: str):
@@ -137,12 +562,19 @@ def stignore_listing(content_type: str):
             400,
         )
 
-    return jsonify(
+    etag = content_etag(content_folder, tree=False)
+
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    response = jsonify(
         {
             "ok": True,
             "entries": load_stignore_file(stignore),
         }
     )
+    response.set_etag(etag)
+    return response
 
 
 @app.route("/api/v1/<content_type>/stignore", methods=["POST"])
@@ -172,9 +604,6 @@ def stignore_modification(content_type: str):
             }
         )
 
-    entries = load_stignore_file(stignore)
-    raw_entries = [e["raw"] for e in entries]
-
     # Insert the payload
     payload = request.get_json(force=True)
 
@@ -186,30 +615,109 @@ def stignore_modification(content_type: str):
     if not actions["ok"]:
         return jsonify(actions)
 
-    for entry in actions["remove"]:
-        if entry in raw_entries:
-            raw_entries.remove(entry)
-
-    for entry in actions["add"]:
-        if entry not in raw_entries:
-            raw_entries.append(entry)
-
     # Write out new stignore file
-    raw_entries.sort()
-    stignore.write_text("\n".join(raw_entries) + "\n" if raw_entries else "")
+    apply_stignore_actions(stignore, actions)
 
     return jsonify({"ok": True, "msg": "Actions applied"})
 
 
+@app.route("/api/v1/stignore", methods=["POST"])
+def stignore_batch_modification():
+    """
+    Apply modifications to the stignore files of several content types
+    The payload maps each content type to its list of actions, every one
+    of them is validated before any file is written. Files are then
+    written concurrently, the result reports each content type's write
+    """
+    folders = current_app.config["folders"]
+
+    payload = request.get_json(force=True)
+
+    if not isinstance(payload, dict) or not isinstance(payload.get("actions"), dict):
+        return (
+            jsonify({"ok": False, "msg": "No provided actions per content_type"}),
+            400,
+        )
+
+    batches = {}
+
+    for content_type, payload_actions in payload["actions"].items():
+        content_folder = folders.get(content_type)
+
+        if content_folder is None:
+            return (
+                jsonify(
+                    {
+                        "ok": False,
+                        "msg": f"Provided content_type {content_type} is not monitored",
+                    }
+                ),
+                400,
+            )
+
+        stignore = content_folder.path / ".stignore"
+
+        if not stignore.exists():
+            return (
+                jsonify(
+                    {
+                        "ok": False,
+                        "msg": f".stignore doesn't exists for {content_type}",
+                    }
+                ),
+                400,
+            )
+
+        if not isinstance(payload_actions, list):
+            return (
+                jsonify(
+                    {"ok": False, "msg": f"No provided actions for {content_type}"}
+                ),
+                400,
+            )
+
+        actions = load_actions(payload_actions)
+
+        if not actions["ok"]:
+            return jsonify({**actions, "content_type": content_type}), 400
+
+        batches[content_type] = (stignore, actions)
+
+    def apply(item):
+        content_type, (stignore, actions) = item
+
+        try:
+            apply_stignore_actions(stignore, actions)
+        except OSError as error:
+            return content_type, {"ok": False, "msg": f"{error.strerror}"}
+
+        return content_type, {"ok": True, "msg": "Actions applied"}
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, len(batches)), thread_name_prefix="stignore-batch"
+    ) as executor:
+        results = dict(executor.map(apply, batches.items()))
+
+    applied = all(result["ok"] for result in results.values())
+
+    return jsonify({"ok": applied, "results": results}), 200 if applied else 500
+
+
 @app.route("/api/v1/<content_type>/stignore/flush")
+@walk_admission
+@profiled
 def stignore_flush_report(content_type: str):
     """
     Prepare a list of actions that would occur if a flush was to happen
     This is a fail safe for the user to verify what *would* happen
+    The signed token returned alongside is posted back to confirm the flush
+    Supports the same ?size= modes as the listing
     """
-    folders = current_app.config["folders"]
+    timer = g.timer
+    size = size_mode()
 
-    content_folder = folders.get(content_type)
+    with timer.phase("config"):
+        content_folder = current_app.config["folders"].get(content_type)
 
     if content_folder is None:
         return (
@@ -230,25 +738,53 @@ def stignore_flush_report(content_type: str):
             400,
         )
 
-    entries = load_stignore_file(stignore)
-    actions = stignore_actions(entries, content_folder.path)
+    if size is None:
+        return jsonify({"ok": False, "msg": "Provided size is invalid"}), 400
+
+    # Concurrent reports for the same content type share a single walk
+    # Patterns are order sensitive, the first one matching a path decides
+    def report_plan():
+        return flush_plan(
+            stignore,
+            content_folder.path,
+            include_size=size != "none",
+            workers=size_workers(content_folder),
+            timer=timer,
+            size_mode=size,
+        )
 
-    return jsonify(
-        {
-            "ok": True,
-            "actions": actions,
-        }
-    )
+    # The shared plan carries the fingerprints it was made with, which are
+    # what the token signs
+    plan = coalesced(flush_report_key(content_type, stignore, size), report_plan)
+
+    report = {
+        "ok": True,
+        "actions": plan["actions"],
+    }
+
+    if current_app.config.get("SECRET_KEY"):
+        # Lets the confirming POST skip re-walking every target
+        report["token"] = sign_flush_plan(
+            current_app.config["SECRET_KEY"], content_type, plan
+        )
+
+    with timer.phase("encode"):
+        return jsonify(report)
 
 
 @app.route("/api/v1/<content_type>/stignore/flush", methods=["POST"])
+@walk_admission
 def stignore_flush_delete(content_type: str):
-    # pylint: disable=too-many-branches
+    # pylint: disable=too-many-branches,too-many-return-statements
     """
     Flush the stignore file by performing all operations marked in it
     This is mainly used to clean up all folders we've marked to ignore
+    Passing "async": true queues the deletes and returns a job_id to poll
+    Passing "mode": "trash" renames them into the trash to be purged later
+    Unsigned confirmations are re-sized with the report's ?size= mode
     """
     folders = current_app.config["folders"]
+    size = size_mode()
 
     content_folder = folders.get(content_type)
 
@@ -271,6 +807,9 @@ def stignore_flush_delete(content_type: str):
             400,
         )
 
+    if size is None:
+        return jsonify({"ok": False, "msg": "Provided size is invalid"}), 400
+
     payload = request.get_json(force=True)
     payload_actions = payload.get("actions")
 
@@ -280,50 +819,247 @@ def stignore_flush_delete(content_type: str):
             400,
         )
 
-    entries = load_stignore_file(stignore)
-    actions = stignore_actions(entries, content_folder.path)
+    if payload.get("token") and current_app.config.get("SECRET_KEY"):
+        # Signed plans only need each target stat'ed, not re-walked
+        plan = verify_flush_plan(
+            current_app.config["SECRET_KEY"],
+            payload["token"],
+            content_type,
+            stignore,
+            payload_actions,
+            max_age=current_app.config["flush_token_max_age"],
+        )
+    else:
+        # Patterns are order sensitive, the first one matching a path decides
+        with g.timer.phase("parse"):
+            entries = load_stignore_file(stignore, sort=False)
+
+        actions = stignore_actions(
+            entries,
+            content_folder.path,
+            include_size=size != "none",
+            workers=content_folder.size_workers,
+            timer=g.timer,
+            size_mode=size,
+        )
+        plan = validate_flush_actions(payload_actions, actions)
+
+    if not plan["ok"]:
+        return jsonify(plan), 400
+
+    actions = plan["actions"]
+
+    if payload.get("mode") == "trash":
+        ignore_trash_folder(stignore)
+        entry = move_to_trash(content_folder.path, actions)
+
+        trash_purger.ensure_running(
+            folders, retention=current_app.config["trash_retention"]
+        )
+
+        return jsonify(
+            {
+                "ok": not entry["errors"],
+                "actions": actions,
+                "trash_id": entry["id"],
+                "errors": entry["errors"],
+            }
+        )
+
+    if payload.get("async"):
+        job = job_queue.submit(
+            content_type,
+            actions,
+            limit=current_app.config["job_queue_size"],
+            throttle=content_folder.throttle,
+        )
+
+        if job is None:
+            return (
+                jsonify({"ok": False, "msg": "Flush queue is full, retry later"}),
+                503,
+                {"Retry-After": "30"},
+            )
+
+        return (
+            jsonify(
+                {
+                    "ok": True,
+                    "job_id": job["id"],
+                    "actions": actions,
+                }
+            ),
+            202,
+        )
+
+    errors = remove_actions(actions, throttle=content_folder.throttle)
 
-    if len(actions) != len(payload_actions):
+    if errors:
         return (
             jsonify(
                 {
                     "ok": False,
-                    "msg": "Invalid actions payload validation (invalid length)",
+                    "msg": "Flush failed to remove some entries",
+                    "actions": actions,
+                    "errors": errors,
                 }
             ),
+            500,
+        )
+
+    return jsonify(
+        {
+            "ok": True,
+            "actions": actions,
+        }
+    )
+
+
+@app.route("/api/v1/<content_type>/trash")
+def trash_listing(content_type: str):
+    """
+    Lists the flushed entries still waiting in the content types trash
+    Each of these can be restored until it is older than the retention
+    """
+    folders = current_app.config["folders"]
+
+    content_folder = folders.get(content_type)
+
+    if content_folder is None:
+        return (
+            jsonify({"ok": False, "msg": "Provided content_type is not monitored"}),
             400,
         )
 
-    for i, (src, dst) in enumerate(zip(payload_actions, actions), start=1):
-        if src.get("path") != dst.get("path"):
-            valid = False
-        elif src.get("action") != dst.get("action"):
-            valid = False
-        elif src.get("size_megabytes") != dst.get("size_megabytes"):
-            valid = False
-        else:
-            valid = True
+    retention = current_app.config["trash_retention"]
 
-        if not valid:
-            return (
-                jsonify(
-                    {
-                        "ok": False,
-                        "msg": f"Invalid actions payload validation (item {i})",
-                    }
-                ),
-                400,
-            )
+    return jsonify(
+        {
+            "ok": True,
+            "trash": [
+                {
+                    "id": entry["id"],
+                    "created": entry["created"],
+                    "purge_after": entry["created"] + retention,
+                    "paths": sorted(entry["items"].values()),
+                }
+                for entry in trash_entries(content_folder.path)
+            ],
+        }
+    )
+
+
+@app.route("/api/v1/<content_type>/trash/<trash_id>/restore", methods=["POST"])
+def trash_restore(content_type: str, trash_id: str):
+    """
+    Undo a trash flush by renaming its entries back into place
+    """
+    folders = current_app.config["folders"]
 
-    for action in actions:
-        if action["action"] != "delete":
-            continue
+    content_folder = folders.get(content_type)
+
+    if content_folder is None:
+        return (
+            jsonify({"ok": False, "msg": "Provided content_type is not monitored"}),
+            400,
+        )
+
+    restored = restore_trash(content_folder.path, trash_id)
 
-        shutil.rmtree(action["path"])
+    if restored is None:
+        return (
+            jsonify({"ok": False, "msg": "Provided trash_id is unknown"}),
+            404,
+        )
 
     return jsonify(
         {
             "ok": True,
-            "actions": actions,
+            "restored": restored,
+        }
+    )
+
+
+@app.route("/metrics")
+def metrics_page():
+    """
+    Exposes request latencies, walk statistics, .stignore parse times and
+    flush removals in the Prometheus text format
+    """
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/api/v1/admission")
+def admission_status():
+    """
+    Reports the walk slots in use, how many requests are queued for one
+    and how many were admitted or rejected per content type
+    """
+    return jsonify({"ok": True, **admission.stats()})
+
+
+@app.route("/api/v1/debug/profiles")
+def profile_listing():
+    """
+    Lists the saved request profiles, only available when profiling is enabled
+    """
+    profile_dir = current_app.config.get("profile_dir")
+
+    if profile_dir is None:
+        return jsonify({"ok": False, "msg": "Profiling is not enabled"}), 404
+
+    return jsonify({"ok": True, "profiles": profile_entries(profile_dir)})
+
+
+@app.route("/api/v1/debug/profiles/<profile_id>")
+def profile_report(profile_id: str):
+    """
+    Returns a saved request profile as a pstats text report
+    Supports ?sort= and ?limit=, or ?format=pstats for the raw stats file
+    """
+    profile_dir = current_app.config.get("profile_dir")
+
+    if profile_dir is None:
+        return jsonify({"ok": False, "msg": "Profiling is not enabled"}), 404
+
+    path = profile_path(profile_dir, profile_id)
+
+    if path is None:
+        return jsonify({"ok": False, "msg": "Provided profile_id is unknown"}), 404
+
+    if request.args.get("format") == "pstats":
+        return send_file(path, as_attachment=True, download_name=f"{profile_id}.pstats")
+
+    sort = request.args.get("sort", "cumulative")
+
+    if sort not in SORT_KEYS:
+        return jsonify({"ok": False, "msg": "Provided sort is invalid"}), 400
+
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Provided limit is invalid"}), 400
+
+    return Response(render_profile(path, sort, limit), mimetype="text/plain")
+
+
+@app.route("/api/v1/jobs/<job_id>")
+def job_status(job_id: str):
+    """
+    Reports the progress of a background flush job
+    Each action carries the bytes freed, files removed and any errors
+    """
+    job = job_queue.get(job_id)
+
+    if job is None:
+        return (
+            jsonify({"ok": False, "msg": "Provided job_id is unknown"}),
+            404,
+        )
+
+    return jsonify(
+        {
+            "ok": True,
+            "job": job,
         }
     )
@@ -0,0 +1,60 @@
+"""
+stignore-agent coalesce
+
+Single-flight coalescing of identical concurrent computations
+"""
+import threading
+
+
+class SingleFlight:
+    """
+    Runs at most one computation per key at a time
+
+    Callers arriving while a computation for their key is in progress wait
+    for it and share its result (or exception) instead of starting their
+    own, so N identical disk walks become one. Results are not cached past
+    the computation finishing, later callers start a fresh one.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, function):
+        """Returns function(), shared with concurrent callers using key"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+
+        if not leader:
+            call["done"].wait()
+
+            if call["error"] is not None:
+                raise call["error"]
+
+            return call["result"]
+
+        try:
+            call["result"] = function()
+        except Exception as error:
+            call["error"] = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call["done"].set()
+
+        return call["result"]
+
+    def in_flight(self):
+        """Number of distinct computations currently running"""
+        with self._lock:
+            return len(self._calls)
+
+
+single_flight = SingleFlight()
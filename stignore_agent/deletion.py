@@ -0,0 +1,292 @@
+"""
+stignore-agent deletion
+
+Removes flushed folders while reporting progress as it goes
+Or moves them into a per content type trash folder to be purged later
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+from stignore_agent import metrics
+
+# Starts with .st so listings skip it like the other syncthing folders
+# Syncthing itself doesn't, the .stignore has to ignore it explicitly
+TRASH_FOLDER = ".stignore-trash"
+MANIFEST = "manifest.json"
+
+# Serialises restores against the purger claiming the same entry
+_trash_lock = threading.Lock()
+
+
+def new_progress(path):
+    """Returns an empty progress record for deleting path"""
+    return {
+        "path": str(path),
+        "status": "pending",
+        "bytes_freed": 0,
+        "files_removed": 0,
+        "errors": [],
+    }
+
+
+class Throttle:
+    """
+    Paces deletes for a content type so Syncthing keeps its share of the disk
+
+    Every unlink or rmdir waits its turn so that neither unlinks_per_second
+    nor bytes_per_second is exceeded. When max_latency_ms is set, a moving
+    average of how long each unlink took is kept and deletes pause for
+    pause seconds at a time while the disk is slower than that.
+    One Throttle is shared by everything deleting within a content type.
+    """
+
+    def __init__(
+        self,
+        unlinks_per_second=None,
+        bytes_per_second=None,
+        max_latency_ms=None,
+        pause=1.0,
+    ):
+        self.unlinks_per_second = unlinks_per_second
+        self.bytes_per_second = bytes_per_second
+        self.max_latency_ms = max_latency_ms
+        self.pause = pause
+
+        self.latency_ms = 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self, size=0):
+        """Blocks until removing an entry of size bytes is allowed"""
+        while self.max_latency_ms is not None and self.latency_ms > self.max_latency_ms:
+            time.sleep(self.pause)
+            # Decay so a single slow unlink can't stall deletes forever
+            self.latency_ms /= 2
+
+        cost = 0.0
+
+        if self.unlinks_per_second:
+            cost = 1 / self.unlinks_per_second
+
+        if self.bytes_per_second:
+            cost = max(cost, size / self.bytes_per_second)
+
+        if not cost:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + cost
+
+        if start > now:
+            time.sleep(start - now)
+
+    def observe(self, seconds):
+        """Feeds how long an unlink took into the latency average"""
+        self.latency_ms = 0.8 * self.latency_ms + 0.2 * seconds * 1000
+
+
+def remove_tree(path, progress=None, throttle=None):
+    """
+    Removes path and everything underneath it, bottom up
+    Every file removed is counted into progress, errors are recorded
+    rather than raised so the rest of the tree is still cleaned up
+    Each unlink is paced by the optional Throttle
+    """
+    if progress is None:
+        progress = new_progress(path)
+
+    if throttle is None:
+        throttle = Throttle()
+
+    progress["status"] = "running"
+    started = time.monotonic()
+
+    def record_error(error):
+        progress["errors"].append(f"{error.filename}: {error.strerror}")
+
+    def remove(target, is_dir=False):
+        try:
+            size = 0 if is_dir else os.lstat(target).st_size
+            throttle.wait(size)
+
+            started = time.monotonic()
+
+            if is_dir:
+                os.rmdir(target)
+            else:
+                os.unlink(target)
+
+            throttle.observe(time.monotonic() - started)
+        except OSError as error:
+            record_error(error)
+            return
+
+        if not is_dir:
+            progress["bytes_freed"] += size
+            progress["files_removed"] += 1
+
+    path = str(path)
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        remove(path)
+    else:
+        for current, dirnames, filenames in os.walk(
+            path, topdown=False, onerror=record_error
+        ):
+            for filename in filenames:
+                remove(os.path.join(current, filename))
+
+            for dirname in dirnames:
+                dirpath = os.path.join(current, dirname)
+                remove(dirpath, is_dir=not os.path.islink(dirpath))
+
+        remove(path, is_dir=True)
+
+    progress["status"] = "failed" if progress["errors"] else "done"
+
+    metrics.rmtree_seconds.observe(time.monotonic() - started)
+    metrics.rmtree_bytes_freed.inc(progress["bytes_freed"])
+
+    return progress
+
+
+def remove_actions(actions, throttle=None):
+    """
+    Removes the path of every delete action in turn
+    Returns the errors encountered across all of them
+    """
+    errors = []
+
+    for action in actions:
+        if action["action"] != "delete":
+            continue
+
+        errors.extend(remove_tree(action["path"], throttle=throttle)["errors"])
+
+    return errors
+
+
+def move_to_trash(content_folder, actions):
+    """
+    Atomically renames every delete action into a new trash entry
+    The entry's manifest records where each item came from for restoring
+    The trash folder must already be ignored, see ignore_trash_folder
+    """
+    trash_id = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    trash_path = os.path.join(content_folder, TRASH_FOLDER, trash_id)
+    os.makedirs(trash_path)
+
+    entry = {"id": trash_id, "created": time.time(), "items": {}, "errors": []}
+
+    for number, action in enumerate(actions):
+        if action["action"] != "delete":
+            continue
+
+        try:
+            os.rename(action["path"], os.path.join(trash_path, str(number)))
+        except OSError as error:
+            entry["errors"].append(f"{action['path']}: {error.strerror}")
+            continue
+
+        entry["items"][str(number)] = os.path.relpath(action["path"], content_folder)
+
+    _write_manifest(trash_path, entry)
+
+    return entry
+
+
+def trash_entries(content_folder):
+    """Returns the manifest of every trash entry, oldest first"""
+    trash_root = os.path.join(content_folder, TRASH_FOLDER)
+
+    if not os.path.isdir(trash_root):
+        return []
+
+    entries = []
+
+    for trash_id in sorted(os.listdir(trash_root)):
+        try:
+            with open(
+                os.path.join(trash_root, trash_id, MANIFEST), "rt", encoding="utf-8"
+            ) as manifest:
+                entries.append(json.load(manifest))
+        except (OSError, ValueError):
+            # Partially purged or not written by us
+            continue
+
+    return entries
+
+
+def restore_trash(content_folder, trash_id):
+    """
+    Renames every item of a trash entry back to where it came from
+    Returns the restored relative paths, or None if the entry doesn't exist
+    Items whose original path has been re-created are left in the trash
+    """
+    trash_path = os.path.join(content_folder, TRASH_FOLDER, trash_id)
+
+    with _trash_lock:
+        entry = next(
+            (e for e in trash_entries(content_folder) if e["id"] == trash_id), None
+        )
+
+        if entry is None:
+            return None
+
+        restored = []
+
+        for number, relative in sorted(entry["items"].items()):
+            original = os.path.join(content_folder, relative)
+
+            if os.path.lexists(original):
+                continue
+
+            os.makedirs(os.path.dirname(original), exist_ok=True)
+            os.rename(os.path.join(trash_path, number), original)
+
+            del entry["items"][number]
+            restored.append(relative)
+
+        if entry["items"]:
+            _write_manifest(trash_path, entry)
+        else:
+            remove_tree(trash_path)
+
+    return restored
+
+
+def purge_trash(content_folder, retention, throttle=None):
+    """Removes every trash entry older than retention seconds"""
+    purged = []
+
+    for entry in trash_entries(content_folder):
+        if time.time() - entry["created"] < retention:
+            continue
+
+        trash_path = os.path.join(content_folder, TRASH_FOLDER, entry["id"])
+
+        # The manifest goes first so a half purged entry can't be restored
+        with _trash_lock:
+            try:
+                os.unlink(os.path.join(trash_path, MANIFEST))
+            except FileNotFoundError:
+                # Restored in the meantime
+                continue
+
+        purged.append(remove_tree(trash_path, throttle=throttle))
+
+    return purged
+
+
+def _write_manifest(trash_path, entry):
+    temp_path = os.path.join(trash_path, MANIFEST + ".tmp")
+
+    with open(temp_path, "wt", encoding="utf-8") as manifest:
+        json.dump(entry, manifest)
+
+    os.replace(temp_path, os.path.join(trash_path, MANIFEST))
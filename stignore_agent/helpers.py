@@ -3,105 +3,640 @@ stignore-agent helpers
 
 Various helper functions to remove complexity from app views
 """
+import base64
+import binascii
+import fcntl
+import hashlib
+import os
+import stat
+import tempfile
+import threading
+import time
+
+from bisect import bisect_right
+from contextlib import contextmanager
 from types import SimpleNamespace
 from pathlib import Path
 
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from stignore_agent import metrics
+from stignore_agent.coalesce import single_flight
+from stignore_agent.deletion import TRASH_FOLDER, Throttle
+from stignore_agent.patterns import compile_patterns, ignored_paths
+from stignore_agent.sizes import size_index
+from stignore_agent.timing import PhaseTimer
+
+
+# Parsed stignore entries keyed by path, shared by every request
+_stignore_cache = {}
+_stignore_write_locks = {}
+_stignore_lock = threading.Lock()
+
 
 def parse_config(config):
     """
     Takes a basic config object and returns the transformed one the app requires
+    Raises ValueError for invalid values
     """
+    size_workers = int(config.get("size_workers", 1))
+    max_concurrent_walks = int(config.get("max_concurrent_walks", 4))
+    etag_ttl = int(config.get("etag_ttl", 30))
+
+    if etag_ttl < 1:
+        # ETags of content types without a watcher are bucketed by it
+        raise ValueError("etag_ttl must be at least 1 second")
+
     return {
         "base_folder": Path(config["base_folder"]),
+        "size_workers": size_workers,
+        "max_concurrent_walks": max_concurrent_walks,
+        "watch": bool(config.get("watch", False)),
+        "rescan_interval": int(config.get("rescan_interval", 300)),
+        "job_queue_size": int(config.get("job_queue_size", 4)),
+        "trash_retention": int(config.get("trash_retention", 900)),
+        "etag_ttl": etag_ttl,
+        "flush_token_max_age": int(config.get("flush_token_max_age", 3600)),
+        "slow_request_ms": int(config.get("slow_request_ms", 1000)),
+        "estimate_max_files": int(config.get("estimate_max_files", 10000)),
+        "estimate_max_ms": int(config.get("estimate_max_ms", 200)),
+        "profile_dir": Path(config["profile_dir"])
+        if config.get("profile_dir")
+        else None,
         "folders": {
             folder["name"]: SimpleNamespace(
                 path=Path(config["base_folder"]) / folder["name"],
                 depth=folder.get("depth", 0),
+                size_workers=int(folder.get("size_workers", size_workers)),
+                throttle=Throttle(
+                    unlinks_per_second=folder.get("delete_unlinks_per_second"),
+                    bytes_per_second=folder.get("delete_bytes_per_second"),
+                    max_latency_ms=folder.get("delete_max_latency_ms"),
+                ),
+                walk_limits=SimpleNamespace(
+                    max_concurrent=max_concurrent_walks,
+                    max_concurrent_per_type=int(
+                        folder.get("max_concurrent_walks", max_concurrent_walks)
+                    ),
+                    max_queued=int(config.get("max_queued_walks", 8)),
+                    queue_timeout=float(config.get("walk_queue_timeout", 5)),
+                ),
             )
             for folder in config["folders"]
         },
     }
 
 
+def paginate_folders(contents, content_folder, limit=None, cursor=None):
+    """
+    Takes a list of folder paths sorted by (name, path)
+    Returns the page of them following the cursor, and the cursor to the next page
+    Cursors are the url safe base64 of the folder path relative to content_folder
+    """
+    page = {"ok": True, "paginated": limit is not None or cursor is not None}
+
+    if cursor:
+        try:
+            relative = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        except (ValueError, binascii.Error, UnicodeError):
+            return {"ok": False, "msg": "Provided cursor is invalid"}
+
+        after = content_folder / relative
+        keys = [(content.name, str(content)) for content in contents]
+        contents = contents[bisect_right(keys, (after.name, str(after))) :]
+
+    next_cursor = None
+
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+
+        if limit < 1:
+            return {"ok": False, "msg": "Provided limit is invalid"}
+
+        if len(contents) > limit:
+            contents = contents[:limit]
+            relative = str(contents[-1].relative_to(content_folder))
+            next_cursor = base64.urlsafe_b64encode(relative.encode("utf-8")).decode(
+                "ascii"
+            )
+
+    page["folders"] = contents
+    page["next_cursor"] = next_cursor
+
+    return page
+
+
+def content_etag(content_folder, *extra, tree=True, ttl=30):
+    """
+    Cheap fingerprint of a content type, used as an ETag
+    Covers the .stignore stat and, with tree, the mtimes of the content
+    type folder and the folders directly underneath it
+    Changes deeper down only show once the SizeIndex has seen them, for
+    content types without a watcher the ETag also rolls over every ttl
+    seconds so those are never hidden for longer than that
+    """
+    parts = list(extra)
+
+    try:
+        parts.append(_stignore_fingerprint(os.stat(content_folder.path / ".stignore")))
+    except FileNotFoundError:
+        parts.append(None)
+
+    if tree:
+        parts.append(size_index.generation)
+
+        with os.scandir(content_folder.path) as children:
+            for child in children:
+                if child.is_dir(follow_symlinks=False):
+                    info = child.stat(follow_symlinks=False)
+                    parts.append((child.name, info.st_mtime_ns, info.st_ino))
+
+        info = os.stat(content_folder.path)
+        parts.append((info.st_mtime_ns, info.st_ino, info.st_nlink))
+
+        if not size_index.is_trusted(content_folder.path):
+            parts.append(int(time.time() // ttl))
+
+    return hashlib.sha1(repr(sorted(parts, key=repr)).encode("utf-8")).hexdigest()
+
+
 def load_stignore_file(filename, sort=True):
     """
     Loads a provided stignore filename
     Parses it into a list of entry objects and returns them
+    Parsed entries are cached until the file's (mtime, inode, size) changes
     """
-    entries = []
+    return load_stignore_snapshot(filename, sort=sort)[0]
+
+
+def load_stignore_snapshot(filename, sort=True):
+    """
+    Like load_stignore_file, returning the entries along with the
+    (mtime, inode, size) fingerprint of the file they were parsed from
+    """
+    key = str(filename)
 
     with open(filename, "rt", encoding="utf-8") as stignore_file:
-        for line in stignore_file:
-            if line.startswith("//") or line == "\n":
-                # Line is a comment or is empty
-                continue
-
-            if line.endswith("\n"):
-                line = line[:-1]
-
-            if line.startswith("!"):
-                ignore_type = "keep"
-                name = line[1:]
-            else:
-                ignore_type = "ignore"
-                name = line
-
-            # We want to drop the trailing slash
-            # As this means 'the contents of the folder but not the folder itself
-            # And we want the folder itself included in this decision
-            if name.endswith("/"):
-                name = name[:-1]
-
-            if line.endswith("/"):
-                line = line[:-1]
-
-            entries.append(
-                {
-                    "raw": line,
-                    "name": name,
-                    "ignore_type": ignore_type,
-                }
-            )
+        fingerprint = _stignore_fingerprint(os.fstat(stignore_file.fileno()))
+
+        with _stignore_lock:
+            cached = _stignore_cache.get(key)
+
+        if cached is not None and cached["fingerprint"] == fingerprint:
+            entries = cached["entries"]
+        else:
+            started = time.perf_counter()
+            entries = parse_stignore_lines(stignore_file)
+            metrics.stignore_parse_seconds.observe(time.perf_counter() - started)
+
+            with _stignore_lock:
+                _stignore_cache[key] = {"fingerprint": fingerprint, "entries": entries}
+
+    # Callers get their own copies to modify
+    entries = [dict(entry) for entry in entries]
 
     if sort:
         entries = sorted(entries, key=lambda x: x["raw"])
 
+    return entries, fingerprint
+
+
+def write_stignore_file(filename, raw_entries):
+    """
+    Writes the provided raw entries out as the stignore file
+    The new contents are fsync'd to a temporary file that is then renamed
+    over the original, so readers never see a partially written file
+    The cache is updated with them directly instead of being invalidated
+    """
+    filename = Path(filename)
+    contents = "\n".join(raw_entries) + "\n" if raw_entries else ""
+
+    # Starting with .st keeps it out of listings and flushes
+    descriptor, temp_name = tempfile.mkstemp(
+        prefix=".stignore.", suffix=".tmp", dir=filename.parent
+    )
+
+    try:
+        with os.fdopen(descriptor, "wt", encoding="utf-8") as temp_file:
+            temp_file.write(contents)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        if filename.exists():
+            os.chmod(temp_name, stat.S_IMODE(filename.stat().st_mode))
+
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+
+    # Persist the rename itself
+    directory = os.open(filename.parent, os.O_RDONLY)
+
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+    entries = parse_stignore_lines(raw_entries)
+
+    with _stignore_lock:
+        _stignore_cache[str(filename)] = {
+            "fingerprint": _stignore_fingerprint(filename.stat()),
+            "entries": entries,
+        }
+
+
+@contextmanager
+def locked_stignore(filename):
+    """
+    Holds the content type's write lock for the stignore file
+    A thread lock orders writers in this process, and an flock on the
+    content type folder orders them against other agent processes
+    """
+    filename = Path(filename)
+
+    with _stignore_lock:
+        lock = _stignore_write_locks.setdefault(str(filename), threading.Lock())
+
+    with lock:
+        directory = os.open(filename.parent, os.O_RDONLY)
+
+        try:
+            fcntl.flock(directory, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the descriptor releases the flock
+            os.close(directory)
+
+
+def apply_stignore_actions(filename, actions):
+    """
+    Applies a load_actions batch to the stignore file in one pass
+    Entries are held in an insertion ordered dict, so every add or remove
+    is a single hash lookup however large the file or batch is
+    The first matching pattern decides, so existing entries keep their
+    order and new ones are appended
+    Returns the raw entries written
+    """
+    with locked_stignore(filename):
+        raw_entries = dict.fromkeys(
+            entry["raw"] for entry in load_stignore_file(filename, sort=False)
+        )
+
+        for entry in actions["remove"]:
+            raw_entries.pop(entry, None)
+
+        for entry in actions["add"]:
+            raw_entries.setdefault(entry)
+
+        raw_entries = list(raw_entries)
+        write_stignore_file(filename, raw_entries)
+
+    return raw_entries
+
+
+def ignore_trash_folder(filename):
+    """
+    Makes sure the stignore file ignores the content type's trash folder
+    Syncthing only skips its own .st* files, so anything renamed into an
+    unignored trash would be sent to every device until it was purged
+    The entry goes first so no keep pattern can rescue the trash, the rest
+    of the file is left exactly as it was
+    """
+    entry = f"/{TRASH_FOLDER}"
+
+    with locked_stignore(filename):
+        with open(filename, "rt", encoding="utf-8") as stignore_file:
+            lines = stignore_file.read().splitlines()
+
+        if entry not in lines:
+            write_stignore_file(filename, [entry] + lines)
+
+
+def parse_stignore_lines(lines):
+    """
+    Parses the lines of a stignore file into a list of entry objects
+    """
+    entries = []
+
+    for line in lines:
+        if line.startswith("//") or line in ("\n", ""):
+            # Line is a comment or is empty
+            continue
+
+        if line.endswith("\n"):
+            line = line[:-1]
+
+        if line.startswith("!"):
+            ignore_type = "keep"
+            name = line[1:]
+        else:
+            ignore_type = "ignore"
+            name = line
+
+        # We want to drop the trailing slash
+        # As this means 'the contents of the folder but not the folder itself
+        # And we want the folder itself included in this decision
+        if name.endswith("/"):
+            name = name[:-1]
+
+        if line.endswith("/"):
+            line = line[:-1]
+
+        entries.append(
+            {
+                "raw": line,
+                "name": name,
+                "ignore_type": ignore_type,
+            }
+        )
+
     return entries
 
 
-def stignore_actions(entries, content_folder, include_size=True):
+def _stignore_fingerprint(info):
+    return (info.st_mtime_ns, info.st_ino, info.st_size)
+
+
+def stignore_actions(
+    entries,
+    content_folder,
+    include_size=True,
+    index=None,
+    workers=1,
+    timer=None,
+    size_mode="apparent",
+):
+    # pylint: disable=too-many-arguments
     """
-    Takes a list of stignore entities
+    Takes a list of stignore entities, in the order they appear in the file
     Returns a list of actions to align the entities to what appears on disk
+    Every entry is a Syncthing ignore pattern, all of them are compiled into
+    one matcher and a single walk of content_folder finds what they ignore
+    Sizes are looked up through the provided (or shared) SizeIndex in
+    size_mode using up to workers threads, timed into the optional PhaseTimer
     """
-    actions = []
+    if index is None:
+        index = size_index
 
-    for entry in entries:
-        if entry["ignore_type"] != "ignore":
-            # We're only looking for entries that could result in cleaning up
-            continue
+    if timer is None:
+        timer = PhaseTimer()
 
-        entry_path = content_folder / entry["name"]
+    with timer.phase("parse"):
+        matcher = compile_patterns(tuple(entry["raw"] for entry in entries))
+
+    with timer.phase("walk"):
+        actions = [
+            {
+                "name": os.path.basename(path),
+                "path": path,
+                "action": "delete",
+            }
+            for path in ignored_paths(matcher, content_folder)
+        ]
+
+    if include_size:
+        size_actions(actions, index, workers=workers, timer=timer, size_mode=size_mode)
+
+    return actions
+
+
+def size_actions(actions, index, workers=1, timer=None, size_mode="apparent"):
+    """Adds the size_megabytes of every action's path, see stignore_actions"""
+    paths = [action["path"] for action in actions]
+
+    for action, size_bytes in zip(
+        actions,
+        index.directory_sizes(paths, workers=workers, timer=timer, mode=size_mode),
+    ):
+        action["size_megabytes"] = size_bytes / 1024 / 1024
+
+
+def flush_plan(
+    stignore,
+    content_folder,
+    include_size=True,
+    workers=1,
+    timer=None,
+    size_mode="apparent",
+):
+    # pylint: disable=too-many-arguments
+    """
+    Returns the stignore_actions of a flush report, along with the
+    fingerprints sign_flush_plan signs them with
+    The .stignore fingerprint is that of the file the patterns were parsed
+    from and every target is fingerprinted before it is sized, so edits
+    made while walking can't be signed as matching the older actions
+    """
+    if timer is None:
+        timer = PhaseTimer()
+
+    with timer.phase("parse"):
+        entries, fingerprint = load_stignore_snapshot(stignore, sort=False)
+
+    actions = stignore_actions(entries, content_folder, include_size=False, timer=timer)
+    targets = [_path_fingerprint(action["path"]) for action in actions]
+
+    if include_size:
+        size_actions(
+            actions, size_index, workers=workers, timer=timer, size_mode=size_mode
+        )
+
+    return {"stignore": list(fingerprint), "actions": actions, "targets": targets}
+
+
+def listing_folders(contents, size, budget=None, workers=1, timer=None):
+    """
+    Lazily sizes each listed folder in the requested ?size= mode, or
+    estimates it within budget's (max_files, max_seconds) when one is given
+    """
+    if size == "none":
+        return ({"name": content.name} for content in contents)
+
+    if budget is None:
+        sizes = size_index.directory_sizes(
+            contents, workers=workers, timer=timer, mode=size
+        )
+
+        return (
+            {"name": content.name, "size_megabytes": round(size_bytes / 1024 / 1024, 2)}
+            for content, size_bytes in zip(contents, sizes)
+        )
+
+    estimates = size_index.estimate_sizes(
+        contents,
+        workers=workers,
+        max_files=budget[0],
+        max_seconds=budget[1],
+        timer=timer,
+        mode=size,
+    )
+
+    def estimated_folders():
+        for content, estimated in zip(contents, estimates):
+            folder = {
+                "name": content.name,
+                "size_megabytes": round(estimated["size"] / 1024 / 1024, 2),
+                "approximate": estimated["approximate"],
+            }
+
+            if estimated["approximate"]:
+                folder["error_megabytes"] = round(estimated["error"] / 1024 / 1024, 2)
+
+            yield folder
+
+    return estimated_folders()
 
-        if not entry_path.exists():
-            # Only looking for entry_path's that exist
-            continue
 
-        action = {
-            "name": str(entry_path.name),
-            "path": str(entry_path),
-            "action": "delete",
+def content_type_summary(content_type, content_folder, timer=None):
+    """
+    Returns the total size, number of folders at the search depth and the
+    size a flush would currently free for a single content type
+    Like the listing the total is that of the folders at the search depth,
+    so Syncthing's .st* folders aren't counted
+    The flush report walk is shared with concurrent flush reports
+    """
+    folders = size_index.folders(content_folder.path, content_folder.depth, timer=timer)
+    size_bytes = sum(
+        size_index.directory_sizes(
+            folders, workers=content_folder.size_workers, timer=timer
+        )
+    )
+
+    stignore = content_folder.path / ".stignore"
+    pending_megabytes = 0
+
+    if stignore.exists():
+        actions = single_flight.run(
+            flush_report_key(content_type, stignore, "apparent"),
+            lambda: flush_plan(
+                stignore,
+                content_folder.path,
+                workers=content_folder.size_workers,
+                timer=timer,
+            ),
+        )["actions"]
+        pending_megabytes = sum(action["size_megabytes"] for action in actions)
+
+    return {
+        "size_megabytes": round(size_bytes / 1024 / 1024, 2),
+        "folder_count": len(folders),
+        "pending_flush_megabytes": round(pending_megabytes, 2),
+    }
+
+
+def validate_flush_actions(payload_actions, actions):
+    """
+    Compares the actions confirmed by the client with freshly computed ones
+    Returns the actions to perform if every one of them matches
+    """
+    if len(actions) != len(payload_actions):
+        return {
+            "ok": False,
+            "msg": "Invalid actions payload validation (invalid length)",
         }
 
-        if include_size:
-            size_bytes = sum(
-                f.stat().st_size for f in entry_path.glob("**/*") if f.is_file()
-            )
-            action["size_megabytes"] = size_bytes / 1024 / 1024
+    for i, (src, dst) in enumerate(zip(payload_actions, actions), start=1):
+        if src.get("path") != dst.get("path"):
+            valid = False
+        elif src.get("action") != dst.get("action"):
+            valid = False
+        elif src.get("size_megabytes") != dst.get("size_megabytes"):
+            valid = False
+        else:
+            valid = True
 
-        actions.append(action)
+        if not valid:
+            return {
+                "ok": False,
+                "msg": f"Invalid actions payload validation (item {i})",
+            }
 
-    return actions
+    return {"ok": True, "actions": actions}
+
+
+def _path_fingerprint(path):
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return None
+
+    return [info.st_dev, info.st_ino, info.st_mtime_ns]
+
+
+def flush_report_key(content_type, stignore, size_mode):
+    """
+    The single_flight key flush_plan walks are shared under
+    It includes the .stignore's current fingerprint, so requests made after
+    an edit never join a walk of the older file
+    """
+    try:
+        fingerprint = _stignore_fingerprint(os.stat(stignore))
+    except FileNotFoundError:
+        fingerprint = None
+
+    return ("flush_report", content_type, size_mode, fingerprint)
+
+
+def sign_flush_plan(secret_key, content_type, plan):
+    """
+    Returns an HMAC signed token covering a flush_plan's actions
+    Along with the .stignore and target fingerprints taken as it was made
+    """
+    serializer = URLSafeTimedSerializer(secret_key, salt="stignore-flush-plan")
+
+    return serializer.dumps(
+        {
+            "content_type": content_type,
+            "stignore": plan["stignore"],
+            "actions": plan["actions"],
+            "targets": plan["targets"],
+        }
+    )
+
+
+def verify_flush_plan(
+    secret_key, token, content_type, stignore, payload_actions, max_age=3600
+):
+    # pylint: disable=too-many-arguments
+    """
+    Checks a token from sign_flush_plan against the disk in O(actions)
+    The .stignore and every target must be stat-identical to when the plan
+    was made, so nothing is re-walked or re-sized
+    Returns the signed actions to perform if it all still holds
+    """
+    serializer = URLSafeTimedSerializer(secret_key, salt="stignore-flush-plan")
+
+    try:
+        plan = serializer.loads(token, max_age=max_age)
+    except BadSignature:
+        return {"ok": False, "msg": "Invalid or expired flush token"}
+
+    if plan["content_type"] != content_type:
+        return {"ok": False, "msg": "Invalid or expired flush token"}
+
+    if plan["stignore"] != list(_stignore_fingerprint(os.stat(stignore))):
+        return {"ok": False, "msg": ".stignore has changed since the flush plan"}
+
+    validation = validate_flush_actions(payload_actions, plan["actions"])
+
+    if not validation["ok"]:
+        return validation
+
+    for i, (action, target) in enumerate(
+        zip(plan["actions"], plan["targets"]), start=1
+    ):
+        if _path_fingerprint(action["path"]) != target:
+            return {
+                "ok": False,
+                "msg": f"Invalid actions payload validation (item {i} changed)",
+            }
+
+    return {"ok": True, "actions": plan["actions"]}
 
 
 def load_actions(actions):
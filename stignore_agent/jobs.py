@@ -0,0 +1,187 @@
+"""
+stignore-agent jobs
+
+Bounded background queue that runs flushes outside of the HTTP request
+And the low priority purger that empties each content type's trash
+"""
+import copy
+import os
+import threading
+import time
+import uuid
+
+from collections import OrderedDict, deque
+
+from stignore_agent.deletion import new_progress, remove_tree, purge_trash
+
+
+class JobQueue:
+    """
+    Runs queued flush jobs one at a time on a single background thread
+
+    Running flushes one after another keeps concurrent flushes from
+    thrashing the same disk. Submitting fails once limit jobs are waiting.
+    Only the most recent finished jobs are kept around for polling.
+    """
+
+    def __init__(self, history=100):
+        self.history = history
+
+        self._jobs = OrderedDict()
+        self._pending = deque()
+        self._lock = threading.Condition()
+        self._worker = None
+
+    def submit(self, content_type, actions, limit=4, throttle=None):
+        """
+        Queues the delete actions for content_type, paced by throttle
+        Returns the new job, or None when the queue is full
+        """
+        with self._lock:
+            if len(self._pending) >= limit:
+                return None
+
+            job = {
+                "id": uuid.uuid4().hex,
+                "content_type": content_type,
+                "status": "queued",
+                "created": time.time(),
+                "started": None,
+                "finished": None,
+                "actions": [
+                    new_progress(action["path"])
+                    for action in actions
+                    if action["action"] == "delete"
+                ],
+            }
+
+            self._jobs[job["id"]] = job
+            self._pending.append((job, throttle))
+            self._trim()
+
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="stignore-jobs", daemon=True
+                )
+                self._worker.start()
+
+            self._lock.notify_all()
+
+            return copy.deepcopy(job)
+
+    def get(self, job_id):
+        """Returns a snapshot of the job, or None if it isn't known"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return copy.deepcopy(job) if job is not None else None
+
+    def depth(self):
+        """Number of jobs waiting to run"""
+        with self._lock:
+            return len(self._pending)
+
+    def wait(self, timeout=None):
+        """Blocks until every queued job has finished, returns True if so"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._lock:
+            while self._pending or any(
+                job["status"] == "running" for job in self._jobs.values()
+            ):
+                remaining = None if deadline is None else deadline - time.monotonic()
+
+                if remaining is not None and remaining <= 0:
+                    return False
+
+                self._lock.wait(remaining)
+
+        return True
+
+    def _trim(self):
+        finished = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job["status"] in ("done", "failed")
+        ]
+
+        for job_id in finished[: max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._lock.wait()
+
+                job, throttle = self._pending.popleft()
+                job["status"] = "running"
+                job["started"] = time.time()
+
+            for progress in job["actions"]:
+                remove_tree(progress["path"], progress, throttle=throttle)
+
+            with self._lock:
+                job["finished"] = time.time()
+                job["status"] = (
+                    "failed"
+                    if any(p["status"] == "failed" for p in job["actions"])
+                    else "done"
+                )
+                self._lock.notify_all()
+
+
+class TrashPurger:
+    """
+    Periodically purges expired trash entries on a niced background thread
+    The thread is started on demand the first time trash is created
+    """
+
+    def __init__(self):
+        self.folders = {}
+        self.retention = 900
+        self.interval = 60
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_running(self, folders, retention=900, interval=60):
+        """Starts (or re-configures) the purger for the given folders"""
+        with self._lock:
+            self.folders = folders
+            self.retention = retention
+            self.interval = interval
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="stignore-purger", daemon=True
+                )
+                self._thread.start()
+
+    def purge(self):
+        """Purges every content type's expired trash entries now"""
+        with self._lock:
+            folders = list(self.folders.values())
+            retention = self.retention
+
+        for folder in folders:
+            try:
+                purge_trash(folder.path, retention, throttle=folder.throttle)
+            except OSError:
+                # Left for the next pass, remove_tree records its own errors
+                continue
+
+    def _run(self):
+        try:
+            # Linux threads can be reniced individually, keeping the purge
+            # out of the way of Syncthing and request handling
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            self.purge()
+            time.sleep(self.interval)
+
+
+job_queue = JobQueue()
+trash_purger = TrashPurger()
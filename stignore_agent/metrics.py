@@ -0,0 +1,227 @@
+"""
+stignore-agent metrics
+
+Minimal in-process metrics rendered in the Prometheus text format
+"""
+import bisect
+import threading
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = tuple(1024**2 * 10**power for power in range(8))
+
+
+class Metric:
+    """
+    Base for a named metric holding one value per set of label values
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Yields (suffix, labels, value) for every sample to render"""
+        with self._lock:
+            values = dict(self._values)
+
+        for labels, value in sorted(values.items()):
+            yield "", labels, value
+
+    def render(self):
+        """Returns the metric's HELP, TYPE and sample lines"""
+        lines = [
+            f"# HELP {self.name} {_escape(self.documentation, quotes=False)}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{self._labels(labels)} {_number(value)}")
+
+        return lines
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+
+        pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+        return "{" + pairs + "}"
+
+
+class Counter(Metric):
+    """A value that only ever goes up"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Adds amount to the counter for labels"""
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value read from function whenever the metrics are rendered
+    function returns a number, or a dict of label value tuples to numbers
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def samples(self):
+        values = self.function()
+
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        for label_values, value in sorted(values.items()):
+            yield "", tuple(zip(self.labelnames, map(str, label_values))), value
+
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets, with their sum and count"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Records a single observation for labels"""
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[position] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(c), total) for key, (c, total) in self._values.items()}
+
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", labels + (("le", _number(bound)),), cumulative
+
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+
+class Registry:
+    """Keeps every metric in registration order for rendering"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Adds metric, returning the one already registered under its name"""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        """Registers and returns a Counter"""
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, function, labelnames=()):
+        """Registers and returns a Gauge reading function"""
+        return self.register(Gauge(name, documentation, function, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """Registers and returns a Histogram"""
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Renders every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value, quotes=True):
+    value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace('"', '\\"') if quotes else value
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+    "stignore_request_duration_seconds",
+    "Time taken to produce each response, by route and method",
+    ("route", "method"),
+)
+requests_total = registry.counter(
+    "stignore_requests_total",
+    "Responses returned, by route, method and status code",
+    ("route", "method", "status"),
+)
+walk_directories = registry.histogram(
+    "stignore_walk_directories",
+    "Directories visited by each sizing walk",
+    buckets=COUNT_BUCKETS,
+)
+walk_files_stat = registry.histogram(
+    "stignore_walk_files_stat",
+    "Files stat'ed by each sizing walk, cached directories cost none",
+    buckets=COUNT_BUCKETS,
+)
+walk_bytes = registry.histogram(
+    "stignore_walk_bytes",
+    "Bytes summed by each sizing walk",
+    buckets=BYTE_BUCKETS,
+)
+stignore_parse_seconds = registry.histogram(
+    "stignore_parse_duration_seconds",
+    "Time taken to parse a .stignore file on a cache miss",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1),
+)
+rmtree_seconds = registry.histogram(
+    "stignore_rmtree_duration_seconds",
+    "Time taken to remove each flushed tree, including throttling",
+)
+rmtree_bytes_freed = registry.counter(
+    "stignore_rmtree_bytes_freed_total",
+    "Bytes freed by removing flushed trees",
+)
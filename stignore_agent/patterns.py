@@ -0,0 +1,262 @@
+"""
+stignore-agent patterns
+
+Compiles the entries of a .stignore file into a single matcher following
+Syncthing's ignore pattern rules, so one walk can classify every path
+"""
+import os
+import re
+
+from functools import lru_cache
+
+
+GLOB_CHARACTERS = set("*?[{\\")
+
+
+class Pattern:
+    """A single parsed .stignore line"""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, line):
+        self.line = line
+        self.number = None
+        self.keep = False
+        self.case_insensitive = False
+
+        while True:
+            if line.startswith("!"):
+                self.keep = True
+                line = line[1:]
+            elif line.startswith("(?i)"):
+                self.case_insensitive = True
+                line = line[4:]
+            elif line.startswith("(?d)"):
+                # Deletable only matters to Syncthing's own directory cleanup
+                line = line[4:]
+            else:
+                break
+
+        self.anchored = line.startswith("/")
+        self.glob = line.lstrip("/").rstrip("/")
+        self.literal = not GLOB_CHARACTERS.intersection(self.glob)
+
+    def regex(self):
+        """
+        Translates the glob into a regex matching relative paths
+        Matching a folder also matches everything underneath it
+        """
+        prefix = "" if self.anchored else "(?:.*/)?"
+        body = _translate(self.glob)[0]
+        regex = f"{prefix}{body}(?:/.*)?"
+
+        return f"(?i:{regex})" if self.case_insensitive else regex
+
+
+class Matcher:
+    """
+    Classifies relative paths against an ordered list of patterns
+
+    Like Syncthing the first pattern that matches decides, so a `!` keep
+    pattern only wins over ignore patterns that come after it. Literal
+    patterns (the ones this agent writes) are looked up in hash tables by
+    path component runs, every other pattern is compiled into one regex
+    alternation whose capturing group tells which pattern matched first.
+    """
+
+    def __init__(self, lines):
+        self.patterns = [
+            Pattern(line)
+            for line in lines
+            if line and not line.startswith("//") and not line.startswith("#")
+        ]
+        self.patterns = [pattern for pattern in self.patterns if pattern.glob]
+
+        for number, pattern in enumerate(self.patterns):
+            pattern.number = number
+
+        self._anchored = {}
+        self._unanchored = {}
+        self._glob_indexes = []
+        globs = []
+
+        for number, pattern in enumerate(self.patterns):
+            if pattern.literal:
+                key = tuple(pattern.glob.split("/"))
+
+                if pattern.case_insensitive:
+                    key = ("(?i)",) + tuple(part.casefold() for part in key)
+
+                table = self._anchored if pattern.anchored else self._unanchored
+                table.setdefault(key, number)
+            else:
+                self._glob_indexes.append(number)
+                globs.append(f"({pattern.regex()})")
+
+        self._regex = re.compile("|".join(globs), re.DOTALL) if globs else None
+
+        keeps = [n for n, pattern in enumerate(self.patterns) if pattern.keep]
+        self._first_keep = keeps[0] if keeps else None
+
+    def match(self, relative):
+        """
+        Returns the first Pattern matching the relative path, or None
+        """
+        number = self._literal_match(relative)
+
+        if self._regex is not None:
+            found = self._regex.fullmatch(relative)
+
+            if found is not None:
+                glob_number = self._glob_indexes[found.lastindex - 1]
+
+                if number is None or glob_number < number:
+                    number = glob_number
+
+        return None if number is None else self.patterns[number]
+
+    def keep_before(self, pattern):
+        """True if a keep pattern precedes pattern, so may rescue its contents"""
+        return self._first_keep is not None and self._first_keep < pattern.number
+
+    def _literal_match(self, relative):
+        if not self._anchored and not self._unanchored:
+            return None
+
+        parts = tuple(relative.split("/"))
+        folded = ("(?i)",) + tuple(part.casefold() for part in parts)
+        found = []
+
+        # Every run of components may match an unanchored pattern, only runs
+        # starting at the root an anchored one. Runs ending early mean the
+        # pattern matched a parent folder of the path.
+        for start in range(len(parts)):
+            for end in range(start + 1, len(parts) + 1):
+                for key in (parts[start:end], folded[:1] + folded[start + 1 : end + 1]):
+                    if key in self._unanchored:
+                        found.append(self._unanchored[key])
+
+                    if not start and key in self._anchored:
+                        found.append(self._anchored[key])
+
+        return min(found) if found else None
+
+
+@lru_cache(maxsize=32)
+def compile_patterns(lines):
+    """Compiles a tuple of raw .stignore lines into a cached Matcher"""
+    return Matcher(lines)
+
+
+def ignored_paths(matcher, content_folder):
+    """
+    Walks content_folder once and returns every path the matcher ignores
+    Ignored folders are returned whole without descending into them,
+    unless an earlier keep pattern could still rescue part of them
+    Syncthing specific entries (.st*) are never returned
+    """
+    return sorted(_classify(matcher, str(content_folder), "")[0])
+
+
+def _classify(matcher, content_folder, relative_dir):
+    """
+    Returns the ignored paths underneath relative_dir, and whether
+    everything underneath it turned out to be ignored
+    """
+    ignored = []
+    complete = True
+
+    try:
+        children = os.scandir(os.path.join(content_folder, relative_dir))
+    except (FileNotFoundError, NotADirectoryError):
+        return ignored, complete
+
+    with children:
+        for child in children:
+            if child.name.startswith(".st"):
+                complete = False
+                continue
+
+            relative = f"{relative_dir}/{child.name}" if relative_dir else child.name
+            is_dir = child.is_dir(follow_symlinks=False)
+            pattern = matcher.match(relative)
+
+            if pattern is None or pattern.keep:
+                complete = False
+
+                if is_dir:
+                    ignored.extend(_classify(matcher, content_folder, relative)[0])
+            elif is_dir and matcher.keep_before(pattern):
+                below, below_complete = _classify(matcher, content_folder, relative)
+
+                if below_complete:
+                    ignored.append(child.path)
+                else:
+                    ignored.extend(below)
+                    complete = False
+            else:
+                ignored.append(child.path)
+
+    return ignored, complete
+
+
+def _translate(glob, position=0, in_braces=False):
+    # pylint: disable=too-many-branches
+    regex = []
+
+    while position < len(glob):
+        char = glob[position]
+
+        if in_braces and char in ",}":
+            break
+
+        if glob.startswith("**/", position):
+            regex.append("(?:.*/)?")
+            position += 3
+        elif glob.startswith("**", position):
+            regex.append(".*")
+            position += 2
+        elif char == "*":
+            regex.append("[^/]*")
+            position += 1
+        elif char == "?":
+            regex.append("[^/]")
+            position += 1
+        elif char == "\\" and position + 1 < len(glob):
+            regex.append(re.escape(glob[position + 1]))
+            position += 2
+        elif char == "[":
+            end = glob.find("]", position + 2)
+
+            if end < 0:
+                regex.append(re.escape(char))
+                position += 1
+                continue
+
+            contents = glob[position + 1 : end]
+
+            if contents[0] in "!^":
+                contents = "^" + contents[1:]
+
+            regex.append("[" + contents.replace("\\", "\\\\") + "]")
+            position = end + 1
+        elif char == "{":
+            options = []
+            position += 1
+
+            while True:
+                option, position = _translate(glob, position, in_braces=True)
+                options.append(option)
+
+                if position >= len(glob) or glob[position] == "}":
+                    position += 1
+                    break
+
+                position += 1
+
+            regex.append("(?:" + "|".join(options) + ")")
+        else:
+            regex.append(re.escape(char))
+            position += 1
+
+    return "".join(regex), position
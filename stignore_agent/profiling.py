@@ -0,0 +1,74 @@
+"""
+stignore-agent profiling
+
+On-demand cProfile captures of single requests, saved as pstats files
+"""
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+import uuid
+
+PROFILE_ID = re.compile(r"^[0-9]+-[a-z_]+-[0-9a-f]{8}$")
+SORT_KEYS = ("cumulative", "tottime", "calls", "ncalls", "time")
+
+
+def profile_call(profile_dir, name, function):
+    """
+    Runs function under cProfile and dumps the stats into profile_dir
+    Returns the function's result and the new profile's id
+    Only the calling thread is profiled
+    """
+    profile_id = f"{int(time.time())}-{name}-{uuid.uuid4().hex[:8]}"
+    profiler = cProfile.Profile()
+
+    try:
+        result = profiler.runcall(function)
+    finally:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f"{profile_id}.pstats"))
+
+    return result, profile_id
+
+
+def profile_entries(profile_dir):
+    """Returns the id, creation time and size of every saved profile"""
+    if not os.path.isdir(profile_dir):
+        return []
+
+    entries = []
+
+    for filename in sorted(os.listdir(profile_dir)):
+        profile_id, extension = os.path.splitext(filename)
+
+        if extension != ".pstats" or not PROFILE_ID.match(profile_id):
+            continue
+
+        info = os.stat(os.path.join(profile_dir, filename))
+        entries.append(
+            {"id": profile_id, "created": info.st_mtime, "size_bytes": info.st_size}
+        )
+
+    return entries
+
+
+def profile_path(profile_dir, profile_id):
+    """Returns the pstats file of profile_id, or None if there isn't one"""
+    if not PROFILE_ID.match(profile_id):
+        return None
+
+    path = os.path.join(profile_dir, f"{profile_id}.pstats")
+
+    return path if os.path.isfile(path) else None
+
+
+def render_profile(path, sort="cumulative", limit=50):
+    """Renders the top limit functions of a pstats file as text"""
+    stream = io.StringIO()
+
+    stats = pstats.Stats(path, stream=stream)
+    stats.sort_stats(sort).print_stats(limit)
+
+    return stream.getvalue()
@@ -0,0 +1,62 @@
+"""
+stignore-agent server
+
+Production serving mode, running the app under gunicorn
+"""
+from gunicorn.app.base import BaseApplication
+
+from stignore_agent.jobs import job_queue
+
+
+class ProductionServer(BaseApplication):
+    """
+    Serves the already configured flask app from gunicorn workers
+
+    Every worker is forked from this process after parse_config has run,
+    so they all share the same configuration. Caches, the watcher and the
+    flush job queue live per worker, which is why concurrency is best
+    added through threads: a job id is only known to the worker that
+    accepted the flush. bin/stignore-agent refuses to watch with several
+    workers and warns when starting them.
+
+    On shutdown each worker stops accepting connections, lets in-flight
+    requests finish and then waits for queued flush jobs, all within
+    graceful_timeout seconds.
+    """
+
+    # pylint: disable=abstract-method
+
+    def __init__(self, application, options, on_worker_start=None):
+        """
+        options carries host, port, workers, threads, keep_alive and
+        graceful_timeout, as parsed from the command line
+        """
+        self.application = application
+        self.on_worker_start = on_worker_start
+        self.options = {
+            "bind": f"{options.host}:{options.port}",
+            "workers": options.workers,
+            "threads": options.threads,
+            "worker_class": "gthread" if options.threads > 1 else "sync",
+            "keepalive": options.keep_alive,
+            "graceful_timeout": options.graceful_timeout,
+            "post_worker_init": self._post_worker_init,
+            "worker_exit": self._worker_exit,
+        }
+
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+    def _post_worker_init(self, _worker):
+        # Threads don't survive the fork, so background work starts per worker
+        if self.on_worker_start is not None:
+            self.on_worker_start()
+
+    def _worker_exit(self, _server, _worker):
+        job_queue.wait(timeout=self.options["graceful_timeout"])
@@ -0,0 +1,503 @@
+"""
+stignore-agent sizes
+
+Directory size index used to answer repeat size lookups from memory
+"""
+import functools
+import math
+import os
+import stat
+import statistics
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from random import Random
+
+from stignore_agent import metrics
+
+
+SIZE_MODES = ("apparent", "blocks")
+
+# Bounds on the probes an estimate takes, whatever its budget
+MIN_PROBES = 8
+MAX_PROBES = 256
+
+
+class SizeIndex:
+    """
+    Caches the direct contents of every directory it has walked
+
+    Each directory node is keyed by its path and stores a fingerprint of
+    (st_mtime_ns, st_ino, st_nlink), the total apparent bytes and allocated
+    blocks of the files directly inside it and the names of its sub
+    directories. Files with more than one link are kept aside by name, as
+    (name, st_nlink, bytes), so sizing by blocks can tell whether deleting
+    a tree would actually free them. A directory's mtime and link count
+    change whenever an entry is added, removed or renamed within it
+    (st_nlink tracking the number of child directories), so a matching
+    fingerprint means only its sub directories need to be checked.
+
+    Files rewritten in place without a rename keep the parent's mtime and
+    will not be picked up until something else in that directory changes.
+    Syncthing always writes via a temporary file and rename.
+
+    Roots marked as trusted (kept up to date by a Watcher) skip the
+    fingerprint check entirely and are answered without touching the disk.
+    """
+
+    def __init__(self):
+        # Bumped whenever a re-listed directory turns out to have changed
+        self.generation = 0
+
+        self._nodes = {}
+        self._trusted = set()
+        self._refining = set()
+        self._refiner = None
+        self._lock = threading.Lock()
+
+    def folders(self, root, depth=0, timer=None):
+        """
+        Returns the folders exactly depth + 1 levels underneath root
+        Syncthing specific folders (.st*) are skipped at every level
+        Time spent is added to the optional PhaseTimer
+        """
+        started = time.perf_counter()
+        level = [str(root)]
+        walk = {"directories": 0, "files": 0, "stat": 0.0}
+
+        for _ in range(depth + 1):
+            next_level = []
+
+            for path in level:
+                node = self._node(path, walk=walk)
+
+                if node is None:
+                    continue
+
+                walk["directories"] += 1
+                next_level.extend(
+                    os.path.join(path, name)
+                    for name in node["subdirs"]
+                    if not name.startswith(".st")
+                )
+
+            level = next_level
+
+        _record(timer, walk, started)
+
+        return [Path(path) for path in level]
+
+    def directory_size(self, path, timer=None, mode="apparent"):
+        """
+        Returns the total size in bytes of all files underneath path
+        (or of path itself when it is a file)
+        mode "apparent" sums file sizes, "blocks" sums the space deleting
+        path would free, so a hardlinked file only counts (once) when every
+        one of its links is underneath path
+        Walks the tree once, adding every directory's files into the total
+        Only directories whose fingerprint changed are re-listed
+        Time spent is added to the optional PhaseTimer
+        """
+        if mode not in SIZE_MODES:
+            raise ValueError(f"Unknown size mode {mode}")
+
+        started = time.perf_counter()
+        path = str(path)
+        walk = {"directories": 0, "files": 0, "stat": 0.0}
+
+        if self._node(path, walk=walk) is None:
+            return _file_size(path, mode)
+
+        total = self._walk_size(path, walk, mode)
+
+        metrics.walk_directories.observe(walk["directories"])
+        metrics.walk_files_stat.observe(walk["files"])
+        metrics.walk_bytes.observe(total)
+        _record(timer, walk, started)
+
+        return total
+
+    def directory_sizes(self, paths, workers=1, timer=None, mode="apparent"):
+        """
+        Yields the size of each path in order, see directory_size for mode
+        Independent folders are sized concurrently when workers > 1
+        """
+        yield from _map(
+            lambda path: self.directory_size(path, timer=timer, mode=mode),
+            paths,
+            workers,
+        )
+
+    def estimate_size(
+        self, path, max_files=None, max_seconds=None, timer=None, mode="apparent"
+    ):
+        # pylint: disable=too-many-arguments
+        """
+        Returns {"size", "error", "approximate"} for path within a budget of
+        files stat'ed and/or seconds
+
+        Half the budget goes on walking path exactly, which a warm cache
+        usually manages. Past that, random root to leaf probes (Knuth's tree
+        size estimator) extrapolate the size from the branching seen along
+        each one, error being two standard errors of their mean. Probes are
+        seeded by path so the same tree gives the same estimate. A full
+        walk is then queued in the background to refine later estimates.
+        """
+        if mode not in SIZE_MODES:
+            raise ValueError(f"Unknown size mode {mode}")
+
+        started = time.perf_counter()
+        path = str(path)
+        walk = {"directories": 0, "files": 0, "stat": 0.0}
+
+        def budget(fraction):
+            return (
+                None if max_files is None else max_files * fraction,
+                None if max_seconds is None else started + max_seconds * fraction,
+            )
+
+        if self._node(path, walk=walk) is None:
+            return {"size": _file_size(path, mode), "error": 0, "approximate": False}
+
+        total = self._walk_size(path, walk, mode, *budget(0.5))
+
+        if total is not None:
+            _record(timer, walk, started)
+            return {"size": total, "error": 0, "approximate": False}
+
+        sampler = Random(path)
+        samples = []
+
+        while len(samples) < MIN_PROBES or (
+            len(samples) < MAX_PROBES and not _exhausted(walk, *budget(1))
+        ):
+            samples.append(self._probe(path, sampler, walk, mode))
+
+        _record(timer, walk, started)
+        self.refine(path)
+
+        return {
+            "size": round(statistics.fmean(samples)),
+            "error": round(2 * statistics.stdev(samples) / math.sqrt(len(samples))),
+            "approximate": True,
+        }
+
+    def estimate_sizes(self, paths, workers=1, **kwargs):
+        """
+        Yields the estimate_size of each path in order, passing on kwargs
+        Independent folders are estimated concurrently when workers > 1
+        """
+        yield from _map(functools.partial(self.estimate_size, **kwargs), paths, workers)
+
+    def refine(self, path):
+        """Queues a full walk of path in the background, once at a time"""
+        path = str(path)
+
+        with self._lock:
+            if path in self._refining:
+                return
+
+            self._refining.add(path)
+
+            if self._refiner is None:
+                self._refiner = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="stignore-refine"
+                )
+
+            refiner = self._refiner
+
+        def walk():
+            try:
+                self.directory_size(path)
+            finally:
+                with self._lock:
+                    self._refining.discard(path)
+
+        refiner.submit(walk)
+
+    def _walk_size(self, path, walk, mode, max_files=None, deadline=None):
+        # pylint: disable=too-many-arguments
+        """
+        Sums every directory underneath path, see directory_size
+        Returns None as soon as walk exceeds max_files stat'ed or deadline
+        """
+        total = 0
+        pending = [path]
+        # (st_dev, st_ino) -> [links seen, st_nlink, bytes]
+        linked = {}
+
+        while pending:
+            if _exhausted(walk, max_files, deadline):
+                return None
+
+            current = pending.pop()
+            node = self._node(current, walk=walk)
+
+            if node is None:
+                continue
+
+            walk["directories"] += 1
+
+            if mode == "blocks":
+                total += node["blocks"]
+                _count_links(current, node["hardlinks"], linked, walk)
+            else:
+                total += node["files"]
+
+            pending.extend(os.path.join(current, name) for name in node["subdirs"])
+
+        return total + sum(
+            size for seen, links, size in linked.values() if seen >= links
+        )
+
+    def _probe(self, path, sampler, walk, mode):
+        """
+        Descends from path through randomly picked sub directories
+        Every directory passed stands in for all its siblings, so its bytes
+        are weighted by the product of the branching factors above it
+        Each link of a hardlinked file counts for its share of the file
+        """
+        estimate = 0
+        weight = 1
+
+        while True:
+            node = self._node(path, walk=walk)
+
+            if node is None:
+                return estimate
+
+            walk["directories"] += 1
+
+            if mode == "blocks":
+                estimate += weight * (
+                    node["blocks"]
+                    + sum(size / links for _, links, size in node["hardlinks"])
+                )
+            else:
+                estimate += weight * node["files"]
+
+            if not node["subdirs"]:
+                return estimate
+
+            weight *= len(node["subdirs"])
+            path = os.path.join(path, sampler.choice(sorted(node["subdirs"])))
+
+    def refresh(self, path):
+        """Re-lists a single directory regardless of its fingerprint"""
+        return self._node(str(path), force=True)
+
+    def trust(self, root):
+        """Serve nodes underneath root from memory, without stat checks"""
+        with self._lock:
+            self._trusted.add(str(root))
+
+    def distrust(self, root):
+        """Go back to validating nodes underneath root by fingerprint"""
+        with self._lock:
+            self._trusted.discard(str(root))
+
+    def clear(self):
+        """Drops every cached directory node"""
+        with self._lock:
+            self._nodes.clear()
+
+    def forget(self, path):
+        """Drops the cached nodes for path and everything underneath it"""
+        path = str(path)
+        prefix = path + "/"
+
+        with self._lock:
+            self._nodes.pop(path, None)
+
+            for key in [k for k in self._nodes if k.startswith(prefix)]:
+                del self._nodes[key]
+
+    def is_trusted(self, path):
+        """True if path is underneath a root kept up to date by a Watcher"""
+        with self._lock:
+            return self._is_trusted(str(path))
+
+    def _is_trusted(self, path):
+        return any(
+            path == root or path.startswith(root + "/") for root in self._trusted
+        )
+
+    def _node(self, path, force=False, walk=None):
+        if not force:
+            with self._lock:
+                node = self._nodes.get(path)
+
+                if node is not None and self._is_trusted(path):
+                    return node
+
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            info = None
+
+        if info is None or not stat.S_ISDIR(info.st_mode):
+            self.forget(path)
+            return None
+
+        fingerprint = (info.st_mtime_ns, info.st_ino, info.st_nlink)
+
+        with self._lock:
+            node = self._nodes.get(path)
+
+        if not force and node is not None and node["fingerprint"] == fingerprint:
+            return node
+
+        listed = _list_directory(path, walk)
+
+        if listed is None:
+            self.forget(path)
+            return None
+
+        changed = node is not None and any(
+            node[key] != listed[key]
+            for key in ("files", "blocks", "hardlinks", "subdirs")
+        )
+        node = {"fingerprint": fingerprint, **listed}
+
+        with self._lock:
+            self._nodes[path] = node
+
+            if changed:
+                self.generation += 1
+
+        return node
+
+
+def _list_directory(path, walk=None):
+    """
+    Lists the direct contents of path, or returns None if it's gone
+    Stat counts and time are added to the optional walk statistics
+    """
+    listed = {"files": 0, "blocks": 0, "hardlinks": [], "subdirs": []}
+    stat_count = 0
+    stat_seconds = 0.0
+
+    try:
+        with os.scandir(path) as children:
+            for child in children:
+                # DirEntry caches the d_type from the listing, so only
+                # regular files cost a single lstat for their size
+                if child.is_dir(follow_symlinks=False):
+                    listed["subdirs"].append(child.name)
+                    continue
+
+                if not child.is_file(follow_symlinks=False):
+                    continue
+
+                stat_started = time.perf_counter()
+                info = _entry_stat(child)
+                stat_seconds += time.perf_counter() - stat_started
+                stat_count += 1
+
+                if info is None:
+                    continue
+
+                listed["files"] += info.st_size
+
+                if info.st_nlink > 1:
+                    listed["hardlinks"].append(
+                        (child.name, info.st_nlink, info.st_blocks * 512)
+                    )
+                else:
+                    listed["blocks"] += info.st_blocks * 512
+    except FileNotFoundError:
+        return None
+
+    if walk is not None:
+        walk["files"] += stat_count
+        walk["stat"] += stat_seconds
+
+    return listed
+
+
+def _count_links(path, hardlinks, linked, walk):
+    """
+    Counts the hardlinked files directly inside path into linked
+    They are stat'ed afresh, as removing a link elsewhere changes their
+    st_nlink without changing path's fingerprint
+    """
+    for name, *_ in hardlinks:
+        stat_started = time.perf_counter()
+
+        try:
+            info = os.lstat(os.path.join(path, name))
+        except FileNotFoundError:
+            continue
+        finally:
+            walk["stat"] += time.perf_counter() - stat_started
+            walk["files"] += 1
+
+        seen = linked.setdefault(
+            (info.st_dev, info.st_ino), [0, info.st_nlink, info.st_blocks * 512]
+        )
+        seen[0] += 1
+
+
+def _map(function, paths, workers):
+    """Yields function(path) for each path in order, concurrently if workers > 1"""
+    if workers <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield function(path)
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="stignore-size"
+    ) as executor:
+        yield from executor.map(function, paths)
+
+
+def _exhausted(walk, max_files=None, deadline=None):
+    if max_files is not None and walk["files"] > max_files:
+        return True
+
+    return deadline is not None and time.perf_counter() > deadline
+
+
+def _file_size(path, mode):
+    # Not a directory, plain files are sized on their own
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return 0
+
+    if not stat.S_ISREG(info.st_mode):
+        return 0
+
+    if mode != "blocks":
+        return info.st_size
+
+    # Deleting one link of several frees nothing, like within _walk_size
+    return info.st_blocks * 512 if info.st_nlink == 1 else 0
+
+
+def _record(timer, walk, started):
+    # Stat time is reported on its own, the rest of the walk is listing
+    if timer is None:
+        return
+
+    seconds = time.perf_counter() - started
+    timer.add(
+        "walk",
+        seconds - walk["stat"],
+        directories=walk["directories"],
+        files=walk["files"],
+    )
+    timer.add("stat", walk["stat"])
+
+
+def _entry_stat(entry):
+    try:
+        return entry.stat(follow_symlinks=False)
+    except FileNotFoundError:
+        # Removed between listing the directory and sizing the file
+        return None
+
+
+size_index = SizeIndex()
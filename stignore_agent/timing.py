@@ -0,0 +1,62 @@
+"""
+stignore-agent timing
+
+Per-request breakdown of where time went, for Server-Timing and slow logs
+"""
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+
+PHASES = ("config", "parse", "walk", "stat", "sort", "encode")
+
+
+class PhaseTimer:
+    """
+    Accumulates the seconds spent in each phase of handling a request
+
+    Phases are summed, so work spread over several sizing threads can add
+    up to more than the request's wall clock time. Alongside the phases
+    the directories visited and files stat'ed by walks are counted.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.counts = Counter()
+
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Times the enclosed block into phase name"""
+        started = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds, **counts):
+        """Adds seconds to phase name, along with any counts"""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+            self.counts.update(counts)
+
+    def elapsed(self):
+        """Seconds since the timer was started"""
+        return time.perf_counter() - self.started
+
+    def header(self):
+        """Renders the phases and total so far as a Server-Timing value"""
+        with self._lock:
+            phases = dict(self.phases)
+
+        metrics = [
+            f"{name};dur={seconds * 1000:.2f}" for name, seconds in phases.items()
+        ]
+        metrics.append(f"total;dur={self.elapsed() * 1000:.2f}")
+
+        return ", ".join(metrics)
@@ -0,0 +1,299 @@
+"""
+stignore-agent watcher
+
+Background thread that keeps the SizeIndex up to date from inotify events
+Content types that can't be fully watched fall back to periodic re-scans
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+from stignore_agent.sizes import size_index
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+    | IN_EXCL_UNLINK
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class WatchLimitExceeded(Exception):
+    """Raised when the kernel refuses any more inotify watches"""
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+    # Raises AttributeError on platforms without inotify
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+    return libc
+
+
+class Watcher(threading.Thread):
+    # pylint: disable=too-many-instance-attributes
+    """
+    Subscribes to change events for every directory underneath the roots
+
+    Events are batched per directory, and each changed directory is re-listed
+    once per batch so the index holds the new sizes before the next request.
+    Watched roots are marked as trusted in the index so listings are answered
+    from memory. Roots that hit the inotify watch limit (or platforms without
+    inotify) are instead re-scanned every rescan_interval seconds.
+    """
+
+    def __init__(self, roots, index=None, rescan_interval=300, logger=None):
+        super().__init__(name="stignore-watcher", daemon=True)
+
+        self.roots = [str(root) for root in roots]
+        self.index = size_index if index is None else index
+        self.rescan_interval = rescan_interval
+        self.logger = logger or logging.getLogger("stignore-agent")
+
+        self.fallback = set()
+        self.ready = threading.Event()
+
+        self._libc = None
+        self._fd = None
+        self._paths = {}
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Ask the watcher to exit and wait for it"""
+        self._stopping.set()
+
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        try:
+            self._libc = _load_libc()
+            self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            self._fd = -1
+
+        if self._fd < 0:
+            self.logger.warning("inotify unavailable, falling back to re-scans")
+            self._fd = None
+            self.fallback.update(self.roots)
+
+        for root in self.roots:
+            if root not in self.fallback:
+                self._watch_root(root)
+
+        self.ready.set()
+
+        try:
+            self._loop()
+        finally:
+            for root in self.roots:
+                self.index.distrust(root)
+
+            if self._fd is not None:
+                os.close(self._fd)
+
+    def _loop(self):
+        next_rescan = time.monotonic() + self.rescan_interval
+
+        while not self._stopping.is_set():
+            if self._fd is not None:
+                readable, _, _ = select.select([self._fd], [], [], 1.0)
+
+                if readable:
+                    self._handle_events()
+            else:
+                self._stopping.wait(1.0)
+
+            if self.fallback and time.monotonic() >= next_rescan:
+                for root in sorted(self.fallback):
+                    # A validating walk re-lists only what changed
+                    self.index.directory_size(root)
+
+                next_rescan = time.monotonic() + self.rescan_interval
+
+    def _watch_root(self, root):
+        try:
+            self._watch_tree(root)
+        except WatchLimitExceeded:
+            self.logger.warning(
+                "inotify watch limit reached for %s, falling back to re-scans", root
+            )
+            # Re-watching after an overflow can get here with root trusted
+            self.index.distrust(root)
+            self._unwatch(root)
+            self.fallback.add(root)
+            return
+
+        self.index.trust(root)
+
+    def _watch_tree(self, path):
+        pending = [path]
+
+        while pending:
+            current = pending.pop()
+
+            watch = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(current), WATCH_MASK
+            )
+
+            if watch < 0:
+                error = ctypes.get_errno()
+
+                if error == errno.ENOSPC:
+                    raise WatchLimitExceeded(current)
+
+                # Vanished or not a directory anymore
+                continue
+
+            self._paths[watch] = current
+
+            # Listing after the watch is in place means nothing is missed
+            node = self.index.refresh(current)
+
+            if node is not None:
+                pending.extend(os.path.join(current, name) for name in node["subdirs"])
+
+    def _unwatch(self, path):
+        prefix = path + "/"
+
+        for watch, watched in list(self._paths.items()):
+            if watched == path or watched.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, watch)
+                del self._paths[watch]
+
+    def _root_of(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(root + "/"):
+                return root
+
+        return None
+
+    def _handle_events(self):
+        changed = set()
+        created = set()
+
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+
+            while offset < len(data):
+                watch, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    self._resync()
+                    return
+
+                path = self._paths.get(watch)
+
+                if path is None:
+                    continue
+
+                if mask & IN_IGNORED:
+                    del self._paths[watch]
+                    continue
+
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    self.index.forget(path)
+                    continue
+
+                changed.add(path)
+
+                if mask & IN_ISDIR and name:
+                    child = os.path.join(path, name)
+
+                    if mask & IN_MOVED_FROM:
+                        self._unwatch(child)
+                        self.index.forget(child)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        created.add(child)
+
+        self._watch_created(created)
+
+        for path in sorted(changed):
+            self.index.refresh(path)
+
+    def _resync(self):
+        # Events were dropped, nothing cached can be relied on
+        self.logger.warning("inotify queue overflow, re-scanning")
+
+        for root in self.roots:
+            if root not in self.fallback:
+                self.index.forget(root)
+                self._unwatch(root)
+                self._watch_root(root)
+
+    def _watch_created(self, created):
+        for path in sorted(created):
+            root = self._root_of(path)
+
+            if root is None or root in self.fallback:
+                continue
+
+            try:
+                self._watch_tree(path)
+            except WatchLimitExceeded:
+                self.logger.warning(
+                    "inotify watch limit reached for %s, falling back to re-scans",
+                    root,
+                )
+                self.index.distrust(root)
+                self._unwatch(root)
+                self.fallback.add(root)
+
+
+def start_watcher(folders, rescan_interval=300, logger=None):
+    """
+    Starts a Watcher for every configured content type folder
+    Returns the running thread once the initial watches are in place
+    """
+    watcher = Watcher(
+        [folder.path for folder in folders.values()],
+        rescan_interval=rescan_interval,
+        logger=logger,
+    )
+    watcher.start()
+    watcher.ready.wait()
+
+    return watcher
@@ -1,7 +1,20 @@
 import json
+import logging
+import os
+import threading
+import time
 
 import pytest
 
+from stignore_agent import app as app_module
+from stignore_agent.app import app
+from stignore_agent.helpers import (
+    load_stignore_file,
+    parse_config,
+    write_stignore_file,
+)
+from stignore_agent.sizes import SizeIndex, size_index
+
 
 def test_content_types(agent):
     response = agent.client.get("/api/v1/discover")
@@ -20,6 +33,72 @@ def test_content_types(agent):
     assert recieved == expected
 
 
+def test_content_types_with_sizes(agent):
+    stignore_path = agent.config["base_folder"] / "share-1" / ".stignore"
+    stignore_path.write_text("Object 1\nObject 3\n")
+
+    response = agent.client.get("/api/v1/discover?sizes=true")
+    assert response.status == "200 OK"
+
+    recieved = json.loads(response.data)
+
+    expected = {
+        "ok": True,
+        "content_types": [
+            {
+                "name": "share-1",
+                "ok": True,
+                "size_megabytes": 42,
+                "folder_count": 3,
+                "pending_flush_megabytes": 30,
+            },
+            {
+                "name": "share-2",
+                "ok": True,
+                "size_megabytes": 43,
+                "folder_count": 5,
+                "pending_flush_megabytes": 0,
+            },
+        ],
+    }
+
+    assert recieved == expected
+
+
+def test_discover_sizes_within_walk_limits(agent, monkeypatch):
+    monkeypatch.setitem(app.config, "max_concurrent_walks", 1)
+
+    for content_folder in agent.config["folders"].values():
+        content_folder.walk_limits.max_concurrent = 1
+        content_folder.walk_limits.max_queued = 0
+
+    summary = app_module.content_type_summary
+
+    def slow_summary(*args, **kwargs):
+        time.sleep(0.1)
+        return summary(*args, **kwargs)
+
+    monkeypatch.setattr(app_module, "content_type_summary", slow_summary)
+
+    # Content types are summarised one at a time rather than rejected
+    response = agent.client.get("/api/v1/discover?sizes=true")
+    assert [c["ok"] for c in response.get_json()["content_types"]] == [True, True]
+
+
+def test_discover_sizes_skip_syncthing_folders(agent):
+    share_1 = agent.config["base_folder"] / "share-1"
+
+    (share_1 / ".stversions").mkdir()
+    (share_1 / ".stversions" / "File 1").write_bytes(b"\0" * 1024 * 1024)
+
+    response = agent.client.get("/api/v1/discover?sizes=true")
+    assert response.status == "200 OK"
+
+    # The total matches the listing, which skips .st* folders
+    share = response.get_json()["content_types"][0]
+    assert (share["name"], share["size_megabytes"]) == ("share-1", 42)
+
+
 def test_content_type_listing(agent):
     response = agent.client.get("/api/v1/share-1/listing")
     assert response.status == "200 OK"
@@ -80,3 +159,597 @@ def test_stignore_listing(agent):
     expected["entries"].sort(key=lambda x: x["raw"])
 
     assert recieved == expected
+
+
+def test_content_type_listing_refreshes_changed_folders(agent):
+    response = agent.client.get("/api/v1/share-1/listing")
+    assert response.status == "200 OK"
+
+    # Only 'Object 2' changes on disk, the index must pick it up
+    object_2 = agent.config["base_folder"] / "share-1" / "Object 2"
+    (object_2 / "File 3").write_bytes(b"\0" * 3 * 1024 * 1024)
+
+    response = agent.client.get("/api/v1/share-1/listing")
+    assert response.status == "200 OK"
+
+    sizes = {f["name"]: f["size_megabytes"] for f in response.get_json()["folders"]}
+
+    assert sizes == {"Object 1": 25, "Object 2": 15, "Object 3": 5}
+
+
+def test_content_type_listing_with_depth(agent):
+    response = agent.client.get("/api/v1/share-2/listing")
+    assert response.status == "200 OK"
+
+    recieved = sorted(
+        (f["name"], f["size_megabytes"]) for f in response.get_json()["folders"]
+    )
+
+    expected = [
+        ("Sub Object 1", 6),
+        ("Sub Object 1", 10),
+        ("Sub Object 2", 6),
+        ("Sub Object 2", 15),
+        ("Sub Object 3", 6),
+    ]
+
+    assert recieved == expected
+
+
+def test_content_type_listing_parallel(agent):
+    agent.config["folders"]["share-2"].size_workers = 4
+
+    response = agent.client.get("/api/v1/share-2/listing")
+    assert response.status == "200 OK"
+
+    recieved = [
+        (f["name"], f["size_megabytes"]) for f in response.get_json()["folders"]
+    ]
+
+    assert [name for name, _ in recieved] == [
+        "Sub Object 1",
+        "Sub Object 1",
+        "Sub Object 2",
+        "Sub Object 2",
+        "Sub Object 3",
+    ]
+    assert sorted(size for _, size in recieved) == [6, 6, 6, 10, 15]
+
+
+def test_content_type_listing_pagination(agent):
+    response = agent.client.get("/api/v1/share-1/listing?limit=2")
+    assert response.status == "200 OK"
+
+    first_page = response.get_json()
+
+    assert [f["name"] for f in first_page["folders"]] == ["Object 1", "Object 2"]
+    assert first_page["next_cursor"] is not None
+
+    response = agent.client.get(
+        f"/api/v1/share-1/listing?limit=2&cursor={first_page['next_cursor']}"
+    )
+    assert response.status == "200 OK"
+
+    assert response.get_json() == {
+        "ok": True,
+        "folders": [{"name": "Object 3", "size_megabytes": 5}],
+        "next_cursor": None,
+    }
+
+    response = agent.client.get("/api/v1/share-1/listing?limit=0")
+    assert response.status == "400 BAD REQUEST"
+
+
+def test_content_type_listing_ndjson(agent):
+    response = agent.client.get(
+        "/api/v1/share-1/listing", headers={"Accept": "application/x-ndjson"}
+    )
+    assert response.status == "200 OK"
+    assert response.mimetype == "application/x-ndjson"
+
+    recieved = [json.loads(line) for line in response.data.decode().splitlines()]
+
+    # Closing the stream hands back its walk slot
+    response.close()
+
+    assert recieved == [
+        {"name": "Object 1", "size_megabytes": 25},
+        {"name": "Object 2", "size_megabytes": 12},
+        {"name": "Object 3", "size_megabytes": 5},
+    ]
+
+    assert agent.client.get("/api/v1/admission").get_json()["running"] == {}
+
+
+def test_stignore_listing_cache(agent):
+    stignore_path = agent.config["base_folder"] / "share-1" / ".stignore"
+    stignore_path.write_text("Object 1/\n")
+
+    entries = load_stignore_file(stignore_path)
+    assert [e["raw"] for e in entries] == ["Object 1"]
+
+    # Callers modifying their entries don't leak into the cache
+    entries[0]["raw"] = "Changed"
+    assert [e["raw"] for e in load_stignore_file(stignore_path)] == ["Object 1"]
+
+    # Changes on disk are picked up by size, inode or mtime
+    stignore_path.write_text("Object 1/\n!Object 2/\n")
+    assert [e["raw"] for e in load_stignore_file(stignore_path)] == [
+        "!Object 2",
+        "Object 1",
+    ]
+
+    # The agent's own writes are served straight from the cache
+    write_stignore_file(stignore_path, ["Object 3"])
+    assert stignore_path.read_text() == "Object 3\n"
+    assert [e["raw"] for e in load_stignore_file(stignore_path)] == ["Object 3"]
+
+
+def test_content_type_listing_etag(agent):
+    response = agent.client.get("/api/v1/share-1/listing")
+    assert response.status == "200 OK"
+
+    etag = response.headers["ETag"]
+
+    response = agent.client.get(
+        "/api/v1/share-1/listing", headers={"If-None-Match": etag}
+    )
+    assert response.status == "304 NOT MODIFIED"
+    assert response.data == b""
+
+    # A different page is a different document
+    response = agent.client.get(
+        "/api/v1/share-1/listing?limit=1", headers={"If-None-Match": etag}
+    )
+    assert response.status == "200 OK"
+
+    object_2 = agent.config["base_folder"] / "share-1" / "Object 2"
+    (object_2 / "File 3").write_bytes(b"\0" * 1024 * 1024)
+
+    response = agent.client.get(
+        "/api/v1/share-1/listing", headers={"If-None-Match": etag}
+    )
+    assert response.status == "200 OK"
+
+
+def test_content_type_listing_etag_per_format(agent):
+    ndjson = {"Accept": "application/x-ndjson"}
+
+    response = agent.client.get("/api/v1/share-1/listing", headers=ndjson)
+    assert response.mimetype == "application/x-ndjson"
+    assert "Accept" in response.headers["Vary"]
+
+    etag = response.headers["ETag"]
+    response.close()
+
+    response = agent.client.get(
+        "/api/v1/share-1/listing", headers={**ndjson, "If-None-Match": etag}
+    )
+    assert response.status == "304 NOT MODIFIED"
+    assert "Accept" in response.headers["Vary"]
+
+    # The JSON form of the same URL isn't the document the client holds
+    response = agent.client.get(
+        "/api/v1/share-1/listing", headers={"If-None-Match": etag}
+    )
+    assert response.status == "200 OK"
+    assert response.mimetype == "application/json"
+    assert response.headers["ETag"] != etag
+
+
+def test_parse_config_etag_ttl(agent_setup):
+    config = {"base_folder": str(agent_setup["base_folder"]), "folders": []}
+
+    assert parse_config({**config, "etag_ttl": 1})["etag_ttl"] == 1
+
+    # ETags are bucketed by it, so zero would fail every listing
+    with pytest.raises(ValueError):
+        parse_config({**config, "etag_ttl": 0})
+
+
+def test_stignore_listing_etag(agent):
+    stignore_path = agent.config["base_folder"] / "share-1" / ".stignore"
+    stignore_path.write_text("Object 1/\n")
+
+    response = agent.client.get("/api/v1/share-1/stignore")
+    etag = response.headers["ETag"]
+
+    response = agent.client.get(
+        "/api/v1/share-1/stignore", headers={"If-None-Match": etag}
+    )
+    assert response.status == "304 NOT MODIFIED"
+
+    stignore_path.write_text("Object 1/\nObject 2/\n")
+
+    response = agent.client.get(
+        "/api/v1/share-1/stignore", headers={"If-None-Match": etag}
+    )
+    assert response.status == "200 OK"
+
+
+def test_content_type_listing_coalesced(agent, monkeypatch):
+    walks = []
+    directory_size = size_index.directory_size
+
+    def slow_directory_size(path, **kwargs):
+        walks.append(path)
+        time.sleep(0.2)
+        return directory_size(path, **kwargs)
+
+    monkeypatch.setattr(size_index, "directory_size", slow_directory_size)
+
+    responses = []
+
+    def get_listing():
+        responses.append(app.test_client().get("/api/v1/share-1/listing"))
+
+    threads = [threading.Thread(target=get_listing) for _ in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert [r.status for r in responses] == ["200 OK"] * 4
+    assert len({r.data for r in responses}) == 1
+
+    # Every folder was only sized once across the concurrent requests
+    assert len(walks) == 3
+
+
+def test_content_type_listing_admission(agent, monkeypatch):
+    agent.config["folders"]["share-1"].walk_limits.max_concurrent_per_type = 1
+    agent.config["folders"]["share-1"].walk_limits.max_queued = 0
+
+    started = threading.Event()
+    directory_size = size_index.directory_size
+
+    def slow_directory_size(path, **kwargs):
+        started.set()
+        time.sleep(0.3)
+        return directory_size(path, **kwargs)
+
+    monkeypatch.setattr(size_index, "directory_size", slow_directory_size)
+
+    slow = threading.Thread(
+        target=lambda: app.test_client().get("/api/v1/share-1/listing")
+    )
+    slow.start()
+    started.wait()
+
+    # The one walk slot for share-1 is taken and nothing may queue for it
+    response = agent.client.get("/api/v1/share-1/listing?limit=1")
+    assert response.status == "503 SERVICE UNAVAILABLE"
+    assert response.headers["Retry-After"] == "5"
+
+    # Other content types aren't held up
+    response = agent.client.get("/api/v1/share-2/listing")
+    assert response.status == "200 OK"
+
+    slow.join()
+
+    stats = agent.client.get("/api/v1/admission").get_json()
+    assert stats["rejected"]["share-1"] >= 1
+    assert stats["running"] == {}
+
+
+def test_content_type_listing_not_modified_skips_admission(agent, monkeypatch):
+    agent.config["folders"]["share-1"].walk_limits.max_concurrent_per_type = 1
+    agent.config["folders"]["share-1"].walk_limits.max_queued = 0
+    monkeypatch.setitem(app.config, "etag_ttl", 3600)
+
+    etag = agent.client.get("/api/v1/share-1/listing?limit=1").headers["ETag"]
+
+    started = threading.Event()
+    directory_size = size_index.directory_size
+
+    def slow_directory_size(path, **kwargs):
+        started.set()
+        time.sleep(0.3)
+        return directory_size(path, **kwargs)
+
+    monkeypatch.setattr(size_index, "directory_size", slow_directory_size)
+
+    slow = threading.Thread(
+        target=lambda: app.test_client().get("/api/v1/share-1/listing")
+    )
+    slow.start()
+    started.wait()
+
+    # Polls that end in a 304 never walk, so don't need the busy slot
+    response = agent.client.get(
+        "/api/v1/share-1/listing?limit=1", headers={"If-None-Match": etag}
+    )
+    assert response.status == "304 NOT MODIFIED"
+
+    response = agent.client.get("/api/v1/share-1/listing?limit=1")
+    assert response.status == "503 SERVICE UNAVAILABLE"
+
+    slow.join()
+
+
+def test_metrics(agent):
+    size_index.clear()
+
+    response = agent.client.get("/api/v1/share-1/listing")
+    assert response.status == "200 OK"
+
+    response = agent.client.get("/metrics")
+    assert response.status == "200 OK"
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+
+    lines = response.data.decode("utf-8").splitlines()
+
+    assert "# TYPE stignore_request_duration_seconds histogram" in lines
+    assert any(
+        line.startswith("stignore_request_duration_seconds_count{")
+        and 'route="/api/v1/<content_type>/listing"' in line
+        for line in lines
+    )
+    assert any(
+        line.startswith("stignore_requests_total{")
+        and 'route="/api/v1/<content_type>/listing"' in line
+        and 'status="200"' in line
+        for line in lines
+    )
+
+    walk_bytes = next(
+        float(line.split()[-1])
+        for line in lines
+        if line.startswith("stignore_walk_bytes_sum ")
+    )
+    assert walk_bytes >= (25 + 10 + 2 + 5) * 1024 * 1024
+
+    assert any(line.startswith("stignore_walk_files_stat_count ") for line in lines)
+    assert any(line.startswith("stignore_walks_queued ") for line in lines)
+
+
+def test_content_type_listing_server_timing(agent, monkeypatch, caplog):
+    size_index.clear()
+
+    directory_size = size_index.directory_size
+
+    def slow_directory_size(path, **kwargs):
+        time.sleep(0.01)
+        return directory_size(path, **kwargs)
+
+    # Sizing the listing is slowed down to always cross the threshold
+    monkeypatch.setattr(size_index, "directory_size", slow_directory_size)
+    monkeypatch.setitem(app.config, "slow_request_ms", 5)
+    monkeypatch.setitem(app.config, "logger", logging.getLogger("stignore-agent-test"))
+
+    with caplog.at_level(logging.WARNING, logger="stignore-agent-test"):
+        response = agent.client.get("/api/v1/share-2/listing")
+        assert response.status == "200 OK"
+
+        # Slow requests are logged once the response is closed
+        response.close()
+
+    timings = {
+        metric.split(";")[0]: float(metric.split("dur=")[1])
+        for metric in response.headers["Server-Timing"].split(", ")
+    }
+
+    assert set(timings) == {
+        "config",
+        "parse",
+        "walk",
+        "stat",
+        "sort",
+        "encode",
+        "total",
+    }
+    assert timings["walk"] > 0
+    assert timings["encode"] > 0
+
+    slow = [
+        json.loads(record.getMessage().split(" ", 2)[2])
+        for record in caplog.records
+        if record.getMessage().startswith("slow request ")
+    ]
+
+    assert len(slow) == 1
+    assert slow[0]["content_type"] == "share-2"
+    assert slow[0]["depth"] == 1
+    assert slow[0]["directories"] >= 7
+    assert slow[0]["files"] >= 5
+    assert set(slow[0]["phases_ms"]) == {
+        "config",
+        "parse",
+        "walk",
+        "stat",
+        "sort",
+        "encode",
+    }
+
+
+def test_content_type_listing_profiled(agent, monkeypatch, tmp_path):
+    size_index.clear()
+
+    response = agent.client.get(
+        "/api/v1/share-1/listing", headers={"X-Stignore-Profile": "1"}
+    )
+    assert response.status == "200 OK"
+    assert "X-Stignore-Profile-Id" not in response.headers
+
+    response = agent.client.get("/api/v1/debug/profiles")
+    assert response.status == "404 NOT FOUND"
+
+    monkeypatch.setitem(app.config, "profile_dir", tmp_path / "profiles")
+
+    # Profiling is opt in per request
+    response = agent.client.get("/api/v1/share-1/listing")
+    assert "X-Stignore-Profile-Id" not in response.headers
+
+    size_index.clear()
+
+    response = agent.client.get(
+        "/api/v1/share-1/listing?format=ndjson",
+        headers={"X-Stignore-Profile": "1"},
+    )
+    assert response.status == "200 OK"
+    assert len(response.data.decode("utf-8").splitlines()) == 3
+
+    profile_id = response.headers["X-Stignore-Profile-Id"]
+
+    response = agent.client.get("/api/v1/debug/profiles")
+    assert [p["id"] for p in response.get_json()["profiles"]] == [profile_id]
+
+    # Sizing ran on the request thread so the walk shows up in the profile
+    response = agent.client.get(f"/api/v1/debug/profiles/{profile_id}?limit=100")
+    assert response.status == "200 OK"
+    assert "directory_size" in response.data.decode("utf-8")
+
+    response = agent.client.get(f"/api/v1/debug/profiles/{profile_id}?format=pstats")
+    assert response.status == "200 OK"
+    assert response.data
+
+    response = agent.client.get("/api/v1/debug/profiles/..%2Fsecret")
+    assert response.status == "404 NOT FOUND"
+
+
+def test_content_type_listing_size_modes(agent):
+    share_1 = agent.config["base_folder"] / "share-1"
+
+    # Hardlinked media is only counted once when sizing by blocks
+    os.link(share_1 / "Object 2" / "File 1", share_1 / "Object 2" / "File 1 link")
+    size_index.clear()
+
+    response = agent.client.get("/api/v1/share-1/listing?size=none")
+    assert response.status == "200 OK"
+    assert response.get_json()["folders"] == [
+        {"name": "Object 1"},
+        {"name": "Object 2"},
+        {"name": "Object 3"},
+    ]
+
+    response = agent.client.get("/api/v1/share-1/listing?size=apparent")
+    sizes = {f["name"]: f["size_megabytes"] for f in response.get_json()["folders"]}
+    assert sizes == {"Object 1": 25, "Object 2": 22, "Object 3": 5}
+
+    response = agent.client.get("/api/v1/share-1/listing?size=blocks")
+    sizes = {f["name"]: f["size_megabytes"] for f in response.get_json()["folders"]}
+    assert sizes["Object 2"] == pytest.approx(12, abs=0.1)
+    assert sizes["Object 1"] == pytest.approx(25, abs=0.1)
+
+    response = agent.client.get("/api/v1/share-1/listing?size=bogus")
+    assert response.status == "400 BAD REQUEST"
+
+
+def test_directory_size_blocks_cross_folder_links(tmp_path):
+    index = SizeIndex()
+
+    for folder in ("A", "B"):
+        (tmp_path / folder).mkdir()
+
+    (tmp_path / "A" / "f").write_bytes(os.urandom(4 * 1024 * 1024))
+    os.link(tmp_path / "A" / "f", tmp_path / "B" / "f")
+
+    # Deleting either folder alone frees nothing, deleting both frees it once
+    assert index.directory_size(tmp_path / "A", mode="blocks") == 0
+    assert index.directory_size(tmp_path / "B", mode="blocks") == 0
+    assert index.directory_size(tmp_path, mode="blocks") == pytest.approx(
+        4 * 1024 * 1024, abs=64 * 1024
+    )
+
+    # Removing the other link makes A's copy reclaimable, even though A's
+    # own cached listing is still current
+    os.unlink(tmp_path / "B" / "f")
+
+    assert index.directory_size(tmp_path / "A", mode="blocks") == pytest.approx(
+        4 * 1024 * 1024, abs=64 * 1024
+    )
+
+
+def test_directory_size_blocks_file_links(tmp_path):
+    index = SizeIndex()
+
+    (tmp_path / "A").mkdir()
+    (tmp_path / "B").mkdir()
+    (tmp_path / "A" / "f.mkv").write_bytes(os.urandom(4 * 1024 * 1024))
+    os.link(tmp_path / "A" / "f.mkv", tmp_path / "B" / "f.mkv")
+
+    # Flush actions can be single files, whose other links lie elsewhere
+    assert index.directory_size(tmp_path / "A" / "f.mkv", mode="blocks") == 0
+    assert index.directory_size(tmp_path / "A" / "f.mkv") == 4 * 1024 * 1024
+
+    os.unlink(tmp_path / "B" / "f.mkv")
+
+    assert index.directory_size(
+        tmp_path / "A" / "f.mkv", mode="blocks"
+    ) == pytest.approx(4 * 1024 * 1024, abs=64 * 1024)
+
+
+def test_stignore_flush_report_size_none(agent):
+    stignore_path = agent.config["base_folder"] / "share-1" / ".stignore"
+    stignore_path.write_text("Object 1\n")
+
+    response = agent.client.get("/api/v1/share-1/stignore/flush?size=none")
+    assert response.status == "200 OK"
+
+    actions = response.get_json()["actions"]
+    assert [(a["name"], "size_megabytes" in a) for a in actions] == [
+        ("Object 1", False)
+    ]
+
+
+def test_estimate_size(tmp_path):
+    index = SizeIndex()
+
+    for folder in range(20):
+        (tmp_path / f"Folder {folder}").mkdir()
+
+        for number in range(20):
+            with open(tmp_path / f"Folder {folder}" / f"File {number}", "wb") as file:
+                file.truncate(1000)
+
+    # Every folder looks alike, so any sample extrapolates to the exact size
+    estimated = index.estimate_size(tmp_path, max_files=50)
+    assert estimated == {"size": 400000, "error": 0, "approximate": True}
+
+    # The background walk fills the cache, after which estimates are exact
+    assert wait_for(
+        lambda: index.estimate_size(tmp_path, max_files=50)["approximate"] is False
+    )
+    assert index.estimate_size(tmp_path, max_files=50)["size"] == 400000
+
+
+def test_content_type_listing_estimate(agent):
+    size_index.clear()
+
+    response = agent.client.get("/api/v1/share-2/listing?estimate=true&max_files=0")
+    assert response.status == "200 OK"
+    assert "ETag" not in response.headers
+
+    listing = response.get_json()
+    assert listing["approximate"] is True
+    assert [(f["name"], f["approximate"]) for f in listing["folders"]] == [
+        ("Sub Object 1", True),
+        ("Sub Object 1", True),
+        ("Sub Object 2", True),
+        ("Sub Object 2", True),
+        ("Sub Object 3", True),
+    ]
+    assert all(f["error_megabytes"] == 0 for f in listing["folders"])
+
+    def refined():
+        response = agent.client.get("/api/v1/share-2/listing?estimate=true&max_files=0")
+        return response.get_json()["approximate"] is False
+
+    assert wait_for(refined)
+
+    response = agent.client.get("/api/v1/share-2/listing?estimate=true&max_ms=-1")
+    assert response.status == "400 BAD REQUEST"
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+
+        time.sleep(0.05)
+
+    return False
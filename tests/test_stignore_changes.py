@@ -1,7 +1,10 @@
 import json
+import threading
 
 import pytest
 
+from stignore_agent.helpers import apply_stignore_actions, load_actions
+
 
 def test_stignore_add_entries(agent):
     # Create the .stignore file
@@ -24,12 +27,11 @@ def test_stignore_add_entries(agent):
     response = agent.client.post("/api/v1/share-1/stignore", json={"actions": actions})
     assert response.status == "200 OK"
 
-    expected_entries = sorted(
-        [
-            "Object 1/",
-            "!Object 2/",
-        ]
-    )
+    # New entries are appended in the order they were given
+    expected_entries = [
+        "Object 1/",
+        "!Object 2/",
+    ]
 
     actual_entries = [
         entry for entry in stignore_path.read_text().split("\n") if entry != ""
@@ -59,14 +61,141 @@ def test_stignore_remove_entries(agent):
     response = agent.client.post("/api/v1/share-1/stignore", json={"actions": actions})
     assert response.status == "200 OK"
 
-    expected_entries = sorted(
-        [
-            "Object 3/",
-        ]
-    )
+    expected_entries = [
+        "Object 3/",
+    ]
 
     actual_entries = [
         entry for entry in stignore_path.read_text().split("\n") if entry != ""
     ]
 
     assert expected_entries == actual_entries
+
+
+def test_stignore_concurrent_batches(agent):
+    stignore_path = agent.config["base_folder"] / "share-1" / ".stignore"
+    stignore_path.write_text("Object 0/\n")
+
+    def add_batch(batch):
+        apply_stignore_actions(
+            stignore_path,
+            load_actions(
+                [
+                    {"action": "add", "ignore_type": "ignore", "name": f"{batch}-{i}"}
+                    for i in range(50)
+                ]
+                + [{"action": "remove", "ignore_type": "ignore", "name": "Object 0"}]
+            ),
+        )
+
+    threads = [threading.Thread(target=add_batch, args=(b,)) for b in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    # No batch was lost to an interleaved write
+    actual_entries = stignore_path.read_text().splitlines()
+
+    assert sorted(actual_entries) == sorted(
+        f"{b}-{i}" for b in range(8) for i in range(50)
+    )
+
+    # Each batch is appended in one piece, in its own order
+    for batch in range(8):
+        start = actual_entries.index(f"{batch}-0")
+        assert actual_entries[start : start + 50] == [f"{batch}-{i}" for i in range(50)]
+    assert not [p for p in stignore_path.parent.iterdir() if p.name.endswith(".tmp")]
+
+
+def test_stignore_entries_keep_file_order(agent):
+    stignore_path = agent.config["base_folder"] / "share-1" / ".stignore"
+
+    # The keep pattern only rescues Object 2 because it comes first
+    stignore_path.write_text("!Object 2\n*\nObject 1\n")
+
+    response = agent.client.post(
+        "/api/v1/share-1/stignore",
+        json={
+            "actions": [
+                {"action": "remove", "ignore_type": "ignore", "name": "Object 1"},
+                {"action": "add", "ignore_type": "ignore", "name": "Object 3"},
+            ]
+        },
+    )
+    assert response.status == "200 OK"
+
+    assert stignore_path.read_text().splitlines() == ["!Object 2", "*", "Object 3"]
+
+
+def test_stignore_batch_entries(agent):
+    share_1 = agent.config["base_folder"] / "share-1" / ".stignore"
+    share_1.write_text("Object 1\n")
+
+    share_2 = agent.config["base_folder"] / "share-2" / ".stignore"
+    share_2.write_text("Object 2\n")
+
+    # One invalid content type fails the whole batch before anything is written
+    response = agent.client.post(
+        "/api/v1/stignore",
+        json={
+            "actions": {
+                "share-1": [
+                    {"action": "add", "ignore_type": "ignore", "name": "Object 2"}
+                ],
+                "share-3": [
+                    {"action": "add", "ignore_type": "ignore", "name": "Object 2"}
+                ],
+            }
+        },
+    )
+    assert response.status == "400 BAD REQUEST"
+    assert share_1.read_text() == "Object 1\n"
+
+    response = agent.client.post(
+        "/api/v1/stignore",
+        json={
+            "actions": {
+                "share-1": [
+                    {"action": "add", "ignore_type": "ignore", "name": "Object 2"},
+                    {"action": "add", "ignore_type": "keep", "name": "Object 3"},
+                ],
+                "share-2": [
+                    {"action": "remove", "ignore_type": "ignore", "name": "Object 2"},
+                    {"action": "bad", "ignore_type": "ignore", "name": "Object 1"},
+                ],
+            }
+        },
+    )
+    assert response.status == "400 BAD REQUEST"
+    assert response.get_json()["content_type"] == "share-2"
+    assert share_1.read_text() == "Object 1\n"
+
+    response = agent.client.post(
+        "/api/v1/stignore",
+        json={
+            "actions": {
+                "share-1": [
+                    {"action": "add", "ignore_type": "ignore", "name": "Object 2"},
+                    {"action": "add", "ignore_type": "keep", "name": "Object 3"},
+                ],
+                "share-2": [
+                    {"action": "remove", "ignore_type": "ignore", "name": "Object 2"},
+                    {"action": "add", "ignore_type": "ignore", "name": "Object 1"},
+                ],
+            }
+        },
+    )
+    assert response.status == "200 OK"
+    assert response.get_json() == {
+        "ok": True,
+        "results": {
+            "share-1": {"ok": True, "msg": "Actions applied"},
+            "share-2": {"ok": True, "msg": "Actions applied"},
+        },
+    }
+
+    assert share_1.read_text().splitlines() == ["Object 1", "Object 2", "!Object 3"]
+    assert share_2.read_text().splitlines() == ["Object 1"]
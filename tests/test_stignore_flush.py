@@ -1,7 +1,22 @@
 import json
+import threading
+import time
 
 import pytest
 
+from stignore_agent.app import app
+
+from stignore_agent.deletion import (
+    Throttle,
+    move_to_trash,
+    purge_trash,
+    remove_tree,
+    trash_entries,
+)
+from stignore_agent.helpers import ignore_trash_folder
+from stignore_agent.patterns import compile_patterns
+from stignore_agent.sizes import size_index
+
 
 def test_stignore_flush_check_does_nothing(agent):
     # Create the .stignore file
@@ -131,3 +146,308 @@ def test_stignore_flush_delete_check_works(agent):
         "ok": False,
         "msg": "Invalid actions payload validation (item 1)",
     }
+
+
+def test_stignore_flush_delete_async(agent):
+    # Create the .stignore file
+    stignore_path = agent.config["base_folder"] / "share-1" / ".stignore"
+
+    # Add in share-1 'Object 2' which does exist locally
+    stignore_path.write_text("Object 2/\n")
+
+    response = agent.client.get("/api/v1/share-1/stignore/flush")
+    assert response.status == "200 OK"
+
+    data = response.get_json()
+    data["async"] = True
+
+    # Post back the pending actions as a background job
+    response = agent.client.post("/api/v1/share-1/stignore/flush", json=data)
+    assert response.status == "202 ACCEPTED"
+
+    job_id = response.get_json()["job_id"]
+
+    for _ in range(100):
+        response = agent.client.get(f"/api/v1/jobs/{job_id}")
+        assert response.status == "200 OK"
+
+        job = response.get_json()["job"]
+
+        if job["status"] in ("done", "failed"):
+            break
+
+        time.sleep(0.05)
+
+    object_2_path = agent.config["base_folder"] / "share-1" / "Object 2"
+
+    assert job["status"] == "done"
+    assert job["actions"] == [
+        {
+            "path": str(object_2_path),
+            "status": "done",
+            "bytes_freed": 12 * 1024 * 1024,
+            "files_removed": 2,
+            "errors": [],
+        }
+    ]
+    assert not object_2_path.exists()
+
+    response = agent.client.get("/api/v1/jobs/unknown")
+    assert response.status == "404 NOT FOUND"
+
+
+def test_stignore_flush_trash_and_restore(agent):
+    # Create the .stignore file
+    stignore_path = agent.config["base_folder"] / "share-1" / ".stignore"
+
+    # Add in share-1 'Object 1' which does exist locally
+    stignore_path.write_text("Object 1/\n")
+
+    response = agent.client.get("/api/v1/share-1/stignore/flush")
+    assert response.status == "200 OK"
+
+    data = response.get_json()
+    data["mode"] = "trash"
+
+    response = agent.client.post("/api/v1/share-1/stignore/flush", json=data)
+    assert response.status == "200 OK"
+
+    trash_id = response.get_json()["trash_id"]
+
+    # Syncthing would otherwise sync the trash out to every device
+    assert stignore_path.read_text() == "/.stignore-trash\nObject 1/\n"
+
+    matcher = compile_patterns(tuple(stignore_path.read_text().splitlines()))
+    assert matcher.match(f".stignore-trash/{trash_id}/0/File 1") is not None
+
+    ignore_trash_folder(stignore_path)
+    assert stignore_path.read_text() == "/.stignore-trash\nObject 1/\n"
+
+    object_1_path = agent.config["base_folder"] / "share-1" / "Object 1"
+    assert not object_1_path.exists()
+
+    # The trash isn't listed as content
+    response = agent.client.get("/api/v1/share-1/listing")
+    assert [f["name"] for f in response.get_json()["folders"]] == [
+        "Object 2",
+        "Object 3",
+    ]
+
+    response = agent.client.get("/api/v1/share-1/trash")
+    assert response.status == "200 OK"
+
+    trash = response.get_json()["trash"]
+    assert [(t["id"], t["paths"]) for t in trash] == [(trash_id, ["Object 1"])]
+
+    response = agent.client.post(f"/api/v1/share-1/trash/{trash_id}/restore")
+    assert response.status == "200 OK"
+    assert response.get_json() == {"ok": True, "restored": ["Object 1"]}
+
+    assert (object_1_path / "File 1").stat().st_size == 25 * 1024 * 1024
+
+    response = agent.client.get("/api/v1/share-1/trash")
+    assert response.get_json() == {"ok": True, "trash": []}
+
+
+def test_stignore_flush_trash_purge(agent):
+    share_1 = agent.config["folders"]["share-1"].path
+    object_3_path = share_1 / "Object 3"
+
+    entry = move_to_trash(share_1, [{"path": str(object_3_path), "action": "delete"}])
+
+    assert not object_3_path.exists()
+
+    purged = purge_trash(share_1, retention=0)
+
+    assert [p["bytes_freed"] for p in purged] == [5 * 1024 * 1024]
+    assert trash_entries(share_1) == []
+    assert not (share_1 / ".stignore-trash" / entry["id"]).exists()
+
+
+def test_throttled_remove_tree(agent):
+    object_2_path = agent.config["base_folder"] / "share-1" / "Object 2"
+
+    # Two files and the folder itself at 20 unlinks a second
+    throttle = Throttle(unlinks_per_second=20)
+
+    started = time.monotonic()
+    progress = remove_tree(object_2_path, throttle=throttle)
+
+    assert time.monotonic() - started >= 0.1
+    assert progress["bytes_freed"] == 12 * 1024 * 1024
+    assert not object_2_path.exists()
+
+    # Deletes hold off while the disk is measured as slow
+    throttle = Throttle(max_latency_ms=1, pause=0.01)
+    throttle.latency_ms = 8
+
+    throttle.wait()
+
+    assert throttle.latency_ms <= 1
+
+
+def test_stignore_flush_check_patterns(agent):
+    stignore_path = agent.config["base_folder"] / "share-1" / ".stignore"
+
+    # Keep patterns only win over the patterns that follow them
+    stignore_path.write_text("!Object 3/\n(?i)*BJECT [12]\nObject 3/\n")
+
+    response = agent.client.get("/api/v1/share-1/stignore/flush")
+    assert response.status == "200 OK"
+
+    share_1 = agent.config["base_folder"] / "share-1"
+
+    assert [
+        (a["path"], a["size_megabytes"]) for a in response.get_json()["actions"]
+    ] == [
+        (str(share_1 / "Object 1"), 25.0),
+        (str(share_1 / "Object 2"), 12.0),
+    ]
+
+    # Unanchored patterns match at any depth, and match files too
+    stignore_path.write_text("**/File 2\n/Object 3/File 1\n")
+
+    response = agent.client.get("/api/v1/share-1/stignore/flush")
+    assert response.status == "200 OK"
+
+    assert [
+        (a["path"], a["size_megabytes"]) for a in response.get_json()["actions"]
+    ] == [
+        (str(share_1 / "Object 2" / "File 2"), 2.0),
+        (str(share_1 / "Object 3" / "File 1"), 5.0),
+    ]
+
+
+def test_stignore_flush_delete_signed_plan(agent, monkeypatch):
+    monkeypatch.setitem(app.config, "SECRET_KEY", b"testing")
+
+    stignore_path = agent.config["base_folder"] / "share-1" / ".stignore"
+    stignore_path.write_text("Object 1/\nObject 2/\n")
+
+    response = agent.client.get("/api/v1/share-1/stignore/flush")
+    assert response.status == "200 OK"
+
+    data = response.get_json()
+    assert data["token"]
+
+    # Tampered tokens are refused
+    response = agent.client.post(
+        "/api/v1/share-1/stignore/flush",
+        json={"actions": data["actions"], "token": data["token"][:-2] + "xx"},
+    )
+    assert response.status == "400 BAD REQUEST"
+    assert response.get_json()["msg"] == "Invalid or expired flush token"
+
+    # A target changing on disk after the plan invalidates it
+    object_2_path = agent.config["base_folder"] / "share-1" / "Object 2"
+    (object_2_path / "File 3").write_bytes(b"\0")
+
+    response = agent.client.post("/api/v1/share-1/stignore/flush", json=data)
+    assert response.status == "400 BAD REQUEST"
+    assert response.get_json()["msg"] == (
+        "Invalid actions payload validation (item 2 changed)"
+    )
+
+    response = agent.client.get("/api/v1/share-1/stignore/flush")
+    data = response.get_json()
+
+    response = agent.client.post("/api/v1/share-1/stignore/flush", json=data)
+    assert response.status == "200 OK"
+    assert response.get_json()["actions"] == data["actions"]
+
+    assert not object_2_path.exists()
+
+
+def test_stignore_flush_plan_signed_as_walked(agent, monkeypatch):
+    monkeypatch.setitem(app.config, "SECRET_KEY", b"testing")
+
+    share_1 = agent.config["base_folder"] / "share-1"
+    stignore_path = share_1 / ".stignore"
+    stignore_path.write_text("/Object 1\n")
+
+    directory_sizes = size_index.directory_sizes
+
+    def edited_while_sizing(paths, **kwargs):
+        stignore_path.write_text("/Object 2\n")
+        return directory_sizes(paths, **kwargs)
+
+    monkeypatch.setattr(size_index, "directory_sizes", edited_while_sizing)
+
+    response = agent.client.get("/api/v1/share-1/stignore/flush")
+    data = response.get_json()
+    assert [a["name"] for a in data["actions"]] == ["Object 1"]
+
+    # The token covers the .stignore the actions came from, not the new one
+    response = agent.client.post("/api/v1/share-1/stignore/flush", json=data)
+    assert response.status == "400 BAD REQUEST"
+    assert response.get_json()["msg"] == ".stignore has changed since the flush plan"
+    assert (share_1 / "Object 1").exists()
+
+    # Targets are fingerprinted before sizing, so changes meanwhile count too
+    stignore_path.write_text("/Object 1\n")
+
+    def changed_while_sizing(paths, **kwargs):
+        (share_1 / "Object 1" / "File 2").write_bytes(b"\0")
+        return directory_sizes(paths, **kwargs)
+
+    monkeypatch.setattr(size_index, "directory_sizes", changed_while_sizing)
+
+    response = agent.client.get("/api/v1/share-1/stignore/flush")
+    data = response.get_json()
+
+    response = agent.client.post("/api/v1/share-1/stignore/flush", json=data)
+    assert response.status == "400 BAD REQUEST"
+    assert response.get_json()["msg"] == (
+        "Invalid actions payload validation (item 1 changed)"
+    )
+    assert (share_1 / "Object 1").exists()
+
+
+def test_stignore_flush_report_not_shared_across_edits(agent, monkeypatch):
+    monkeypatch.setitem(app.config, "SECRET_KEY", b"testing")
+
+    share_1 = agent.config["base_folder"] / "share-1"
+    stignore_path = share_1 / ".stignore"
+    stignore_path.write_text("/Object 1\n")
+
+    sizing = threading.Event()
+    release = threading.Event()
+    directory_sizes = size_index.directory_sizes
+
+    def slow_directory_sizes(paths, **kwargs):
+        if not sizing.is_set():
+            sizing.set()
+            release.wait(5)
+
+        return directory_sizes(paths, **kwargs)
+
+    monkeypatch.setattr(size_index, "directory_sizes", slow_directory_sizes)
+
+    leader = threading.Thread(
+        target=lambda: app.test_client().get("/api/v1/share-1/stignore/flush")
+    )
+    leader.start()
+    sizing.wait(5)
+
+    stignore_path.write_text("/Object 2\n")
+
+    # Made after the edit, so it can't be handed the leader's older plan
+    follower = []
+    follower_thread = threading.Thread(
+        target=lambda: follower.append(
+            app.test_client().get("/api/v1/share-1/stignore/flush").get_json()
+        )
+    )
+    follower_thread.start()
+    follower_thread.join(0.5)
+    release.set()
+    follower_thread.join()
+    leader.join()
+
+    data = follower[0]
+    assert [a["name"] for a in data["actions"]] == ["Object 2"]
+
+    response = agent.client.post("/api/v1/share-1/stignore/flush", json=data)
+    assert response.status == "200 OK"
+    assert not (share_1 / "Object 2").exists()
+    assert (share_1 / "Object 1").exists()
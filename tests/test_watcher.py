@@ -0,0 +1,93 @@
+import os
+import time
+
+import pytest
+
+from stignore_agent.sizes import SizeIndex
+from stignore_agent.watcher import Watcher, WatchLimitExceeded
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+
+        time.sleep(0.05)
+
+    return False
+
+
+@pytest.fixture
+def watched(agent):
+    index = SizeIndex()
+    share_1 = agent.config["folders"]["share-1"].path
+
+    watcher = Watcher([share_1], index=index, rescan_interval=1)
+    watcher.start()
+    watcher.ready.wait()
+
+    yield index, watcher, share_1
+
+    watcher.stop()
+
+
+def test_watcher_applies_changes(watched):
+    index, watcher, share_1 = watched
+
+    assert watcher.fallback == set()
+    assert index.directory_size(share_1) == 42 * 1024 * 1024
+
+    (share_1 / "Object 2" / "File 3").write_bytes(b"\0" * 1024 * 1024)
+    (share_1 / "Object 4").mkdir()
+    (share_1 / "Object 4" / "File 1").write_bytes(b"\0" * 1024 * 1024)
+
+    assert wait_for(lambda: index.directory_size(share_1) == 44 * 1024 * 1024)
+    assert index.directory_size(share_1 / "Object 4") == 1024 * 1024
+
+
+def test_watcher_falls_back_to_rescans(agent, monkeypatch):
+    share_1 = agent.config["folders"]["share-1"].path
+    index = SizeIndex()
+
+    def no_watches(self, path):
+        raise WatchLimitExceeded(path)
+
+    monkeypatch.setattr(Watcher, "_watch_tree", no_watches)
+
+    watcher = Watcher([share_1], index=index, rescan_interval=0)
+    watcher.start()
+    watcher.ready.wait()
+
+    try:
+        assert watcher.fallback == {str(share_1)}
+        assert wait_for(lambda: index.directory_size(share_1) == 42 * 1024 * 1024)
+    finally:
+        watcher.stop()
+
+
+def test_watcher_overflow_at_watch_limit(watched, monkeypatch):
+    index, watcher, share_1 = watched
+
+    assert index.is_trusted(share_1)
+
+    def no_watches(self, path):
+        raise WatchLimitExceeded(path)
+
+    def overflow(self):
+        os.read(self._fd, 64 * 1024)
+        self._resync()
+
+    # Every event is an overflow, and re-watching the root hits the limit
+    monkeypatch.setattr(Watcher, "_watch_tree", no_watches)
+    monkeypatch.setattr(Watcher, "_handle_events", overflow)
+
+    (share_1 / "Object 4").mkdir()
+
+    assert wait_for(lambda: str(share_1) in watcher.fallback)
+    assert not index.is_trusted(share_1)
+
+    (share_1 / "Object 4" / "File 1").write_bytes(b"\0" * 1024 * 1024)
+
+    assert wait_for(lambda: index.directory_size(share_1) == 43 * 1024 * 1024)